@@ -1,8 +1,8 @@
 # -------------------------------------------------------------------------------------------------------
 # BatchDownloadZipFiles.py
-# Version:  Python 2.7.5
+# Version:  Python 3.x
 # Creation Date: 2015-07-14
-# Last Edit: 2018-05-29
+# Last Edit: 2026-10-16
 # Creator:  Kirsten R. Hazler
 # Credits:  I adapted the FTP-related procedures from code provided by Adam Thom, here:  
 # https://gis.stackexchange.com/questions/59047/downloading-multiple-files-from-tiger-ftp-site/
@@ -38,6 +38,11 @@
 #     suf = '_ArcGrid.zip' (for ArcGrid format)
 #     ftpHOST = 'rockyftp.cr.usgs.gov'
 #     ftpDIR = 'vdelivery/Datasets/Staged/Elevation/1/ArcGrid' (for 1 arc-second data)
+#
+# HTTPS mirrors
+#     Most of the above files are also published over HTTPS. If httpURL is given (the HTTPS folder matching ftpDIR,
+#     e.g. 'https://www2.census.gov/geo/tiger/TIGER2014/ROADS'), each file is downloaded from there in several
+#     byte-range segments at once, falling back to FTP for any file which fails over HTTPS.
 # -------------------------------------------------------------------------------------------------------
 
 # Import required modules
@@ -50,10 +55,296 @@ import sys  # provides access to Python system functions
 import traceback  # used for error handling
 import gc  # garbage collection
 import datetime  # for time stamps
+import threading  # for per-thread FTP connections
+import urllib.request  # for HTTPS downloads
+import tempfile  # for holding downloads in memory before extraction
+import shutil  # for copying from the data connection to file
+from concurrent.futures import ThreadPoolExecutor  # for parallel downloads
+import asyncio  # for concurrent downloads with aioftp
+try:
+   # Optional: aioftp runs many FTP sessions from one thread (see BatchDownloadZips' useAsync option)
+   import aioftp
+except ImportError:
+   aioftp = None
 from datetime import datetime
 
+# Transfer settings for downloads. Larger blocks and socket buffers let the TCP window fill on fast links.
+BLOCKSIZE = 1 << 20  # bytes copied at a time from the data connection
+RCVBUF = 4 << 20  # socket receive buffer size for data connections
+
+# Zips which are not kept are written to a RAM-backed folder if there is one (Linux), so they never touch the disk
+RAMDIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+class _BigBufferFTP(ftplib.FTP):
+   '''FTP connection which requests a large receive buffer on each data connection'''
+   def ntransfercmd(self, cmd, rest=None):
+      conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+      try:
+         conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+      except (socket.error, OSError):
+         pass
+      return conn, size
+
+
+# Each download thread keeps its own FTP connection here, so it only needs to connect/login/cwd once.
+# All open connections are also tracked in a list, so they can be closed when downloads finish.
+_ftpLocal = threading.local()
+_ftpOpen = list()
+_ftpLock = threading.Lock()
+
+
+def _retrieve(ftp, fileName, local_file):
+   '''Downloads a file over an open FTP connection into an open file object. This reads the data connection in
+   BLOCKSIZE blocks via copyfileobj, rather than calling back into Python for each block received as retrbinary does.'''
+   ftp.voidcmd('TYPE I')
+   with ftp.transfercmd('RETR ' + fileName) as conn:
+      with conn.makefile('rb', buffering=BLOCKSIZE) as src:
+         shutil.copyfileobj(src, local_file, BLOCKSIZE)
+   ftp.voidresp()
+   return
+
+
+def _getFTP(ftpHOST, ftpDIR):
+   '''Returns the FTP connection owned by the current thread, opening it (login + cwd) on first use'''
+   ftp = getattr(_ftpLocal, 'ftp', None)
+   if ftp is None:
+      ftp = _BigBufferFTP(ftpHOST)
+      ftp.set_pasv(True)
+      ftp.login()
+      ftp.cwd(ftpDIR)
+      _ftpLocal.ftp = ftp
+      with _ftpLock:
+         _ftpOpen.append(ftp)
+   return ftp
+
 
-def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='', extract=True, overwrite=False):
+def _quitFTP(ftp):
+   '''Closes an FTP connection, without complaining if it is already broken'''
+   try:
+      ftp.quit()
+   except:
+      ftp.close()
+   return
+
+
+def _dropFTP():
+   '''Closes and forgets the FTP connection owned by the current thread, if any'''
+   ftp = getattr(_ftpLocal, 'ftp', None)
+   if ftp is not None:
+      with _ftpLock:
+         _ftpOpen.remove(ftp)
+      _quitFTP(ftp)
+      _ftpLocal.ftp = None
+   return
+
+
+def _closeAllFTP():
+   '''Closes all FTP connections opened by download threads'''
+   with _ftpLock:
+      while _ftpOpen:
+         _quitFTP(_ftpOpen.pop())
+   return
+
+
+def DownloadZip(fileName, out_dir, ftpHOST, ftpDIR, overwrite=False, unzipDir=None, keepZip=True):
+   '''Downloads a single file from an FTP site, using the calling thread's own FTP connection.
+   If unzipDir is given, the file is extracted there as soon as it is downloaded. If keepZip is also False, the zip is
+   downloaded to a temporary file (in RAMDIR if available), deleted after extraction, and never written to out_dir.
+   Returns a status string for the processing log.'''
+   outFile = os.path.join(out_dir, fileName)
+   dlFile = outFile
+   writing = False
+   try:
+      ftp = _getFTP(ftpHOST, ftpDIR)
+      if os.path.exists(outFile) and not overwrite:
+         # Only skip files which are complete, i.e. the same size as on the server (e.g. not cut off by a failed run)
+         try:
+            ftp.voidcmd('TYPE I')
+            complete = os.path.getsize(outFile) == ftp.size(fileName)
+         except ftplib.error_perm:
+            # Server does not support SIZE; assume the file is complete. Any other error (e.g. a dropped connection)
+            # fails this download, rather than keeping a file that may be cut off.
+            complete = True
+         if complete:
+            print('Already downloaded %s ...' % fileName)
+            return _extractStatus('Already downloaded %s' % fileName, outFile, unzipDir, True)
+      print('Downloading %s ...' % fileName)
+      if unzipDir and not keepZip:
+         # Download to a named temporary file (as in DownloadZipHTTP), since zipfile cannot read a
+         # SpooledTemporaryFile before Python 3.11
+         fd, dlFile = tempfile.mkstemp(suffix='_' + fileName, dir=RAMDIR)
+         os.close(fd)
+      writing = True
+      with open(dlFile, 'wb', buffering=BLOCKSIZE) as local_file:
+         _retrieve(ftp, fileName, local_file)
+   except:
+      # Drop this thread's connection, in case it is what failed; the next file will open a fresh one
+      _dropFTP()
+      # Remove any partial or temporary file, so it is not mistaken for a complete download later
+      if (writing or dlFile != outFile) and os.path.exists(dlFile):
+         os.remove(dlFile)
+      return 'Failed to download %s' % fileName
+   return _extractStatus('Successfully downloaded %s' % fileName, dlFile, unzipDir, keepZip)
+
+
+def _extractStatus(status, zfile, unzipDir, keepZip):
+   '''Extracts a downloaded zip (path or file object) to unzipDir, if given, and adds the result to the status string.
+   Deletes the zip file afterwards if keepZip is False.'''
+   if not unzipDir:
+      return status
+   try:
+      BatchExtractZipFiles.ExtractZip(zfile, unzipDir)
+      status += '; extracted'
+   except:
+      status += '; failed to extract'
+   if not keepZip and isinstance(zfile, str):
+      try:
+         os.remove(zfile)
+      except OSError:
+         pass
+   return status
+
+
+def _httpInfo(url):
+   '''Returns the size of a file on an HTTP(S) server, and whether the server accepts byte-range requests'''
+   req = urllib.request.Request(url, method='HEAD')
+   with urllib.request.urlopen(req) as resp:
+      size = int(resp.headers.get('Content-Length', 0))
+      ranges = resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+   return size, ranges
+
+
+def _httpSegment(url, outFile, start, end):
+   '''Downloads bytes start-end (inclusive) of a file, writing them at the same position in outFile'''
+   req = urllib.request.Request(url, headers={'Range': 'bytes=%s-%s' % (start, end)})
+   with urllib.request.urlopen(req) as resp:
+      if resp.status != 206:
+         raise IOError('Server ignored range request for %s' % url)
+      with open(outFile, 'r+b', buffering=0) as local_file:
+         local_file.seek(start)
+         while True:
+            block = resp.read(BLOCKSIZE)
+            if not block:
+               break
+            local_file.write(block)
+   return
+
+
+def DownloadZipHTTP(fileName, out_dir, httpURL, overwrite=False, segments=4, unzipDir=None, keepZip=True):
+   '''Downloads a single file from an HTTP(S) site. If the server accepts byte-range requests, the file is split into
+   segments which are downloaded at the same time, each into its own part of the output file.
+   If unzipDir is given, the file is extracted there as soon as it is downloaded. If keepZip is also False, the zip is
+   downloaded to a temporary file (in RAMDIR if available) and deleted after extraction.
+   Returns a status string for the processing log; raises an error if the download fails.'''
+   outFile = os.path.join(out_dir, fileName)
+   url = httpURL.rstrip('/') + '/' + fileName
+   size, ranges = _httpInfo(url)
+   if os.path.exists(outFile) and not overwrite and (size == 0 or os.path.getsize(outFile) == size):
+      # Only skip files which are complete, i.e. the same size as on the server
+      print('Already downloaded %s ...' % fileName)
+      return _extractStatus('Already downloaded %s' % fileName, outFile, unzipDir, True)
+   print('Downloading %s ...' % fileName)
+   if unzipDir and not keepZip:
+      # Download to a temporary file (in RAMDIR if available), deleted after extraction
+      fd, outFile = tempfile.mkstemp(suffix='_' + fileName, dir=RAMDIR)
+      os.close(fd)
+   try:
+      if ranges and size > 0 and segments > 1:
+         # Pre-size the output file, then fill in each segment
+         with open(outFile, 'wb') as local_file:
+            local_file.truncate(size)
+         step = -(-size // segments)
+         bounds = [(a, min(a + step, size) - 1) for a in range(0, size, step)]
+         with ThreadPoolExecutor(max_workers=len(bounds)) as ex:
+            futures = [ex.submit(_httpSegment, url, outFile, a, b) for (a, b) in bounds]
+            for f in futures:
+               f.result()
+      else:
+         with urllib.request.urlopen(url) as resp, open(outFile, 'wb', buffering=BLOCKSIZE) as local_file:
+            while True:
+               block = resp.read(BLOCKSIZE)
+               if not block:
+                  break
+               local_file.write(block)
+   except:
+      # Remove any partial file (a pre-sized one is already full size), so it is not mistaken for a complete download
+      if os.path.exists(outFile):
+         os.remove(outFile)
+      raise
+   return _extractStatus('Successfully downloaded %s' % fileName, outFile, unzipDir, keepZip)
+
+
+async def _asyncDownloadAll(FileList, out_dir, ftpHOST, ftpDIR, overwrite=False, unzipDir=None, keepZip=True,
+                            max_workers=8):
+   '''Downloads a list of files from an FTP site with aioftp. max_workers sessions are run at once from a single event
+   loop, each pulling file names from a shared queue. Extraction (if unzipDir is given) runs in a thread pool so it
+   does not hold up the downloads. Returns a list of status strings in the same order as FileList.'''
+   loop = asyncio.get_running_loop()
+   queue = asyncio.Queue()
+   for i, fileName in enumerate(FileList):
+      queue.put_nowait((i, fileName))
+   results = [None] * len(FileList)
+
+   async def worker():
+      client = None
+      while not queue.empty():
+         i, fileName = queue.get_nowait()
+         outFile = os.path.join(out_dir, fileName)
+         dlFile = outFile
+         writing = False
+         try:
+            if client is None:
+               client = aioftp.Client()
+               await client.connect(ftpHOST)
+               await client.login()
+               await client.change_directory(ftpDIR)
+            if os.path.exists(outFile) and not overwrite:
+               # Only skip files which are complete, i.e. the same size as on the server. As in DownloadZip, if the server
+               # cannot report a size (a permanent 5xx reply), assume the file is complete; other errors fail the file.
+               try:
+                  info = await client.stat(fileName)
+                  complete = 'size' not in info or os.path.getsize(outFile) == int(info['size'])
+               except aioftp.StatusCodeError as e:
+                  if not any(str(c).startswith('5') for c in e.received_codes):
+                     raise
+                  complete = True
+               if complete:
+                  print('Already downloaded %s ...' % fileName)
+                  results[i] = await loop.run_in_executor(
+                     None, _extractStatus, 'Already downloaded %s' % fileName, outFile, unzipDir, True)
+                  continue
+            print('Downloading %s ...' % fileName)
+            if unzipDir and not keepZip:
+               # Download to a temporary file (in RAMDIR if available), deleted after extraction
+               fd, dlFile = tempfile.mkstemp(suffix='_' + fileName, dir=RAMDIR)
+               os.close(fd)
+            writing = True
+            await client.download(fileName, dlFile, write_into=True)
+         except Exception:
+            # Drop this session, in case it is what failed; the next file will open a fresh one
+            if client is not None:
+               client.close()
+               client = None
+            # Remove any partial or temporary file, so it is not mistaken for a complete download later
+            if (writing or dlFile != outFile) and os.path.exists(dlFile):
+               os.remove(dlFile)
+            results[i] = 'Failed to download %s' % fileName
+            continue
+         results[i] = await loop.run_in_executor(
+            None, _extractStatus, 'Successfully downloaded %s' % fileName, dlFile, unzipDir, keepZip)
+      if client is not None:
+         try:
+            await client.quit()
+         except Exception:
+            client.close()
+
+   await asyncio.gather(*(worker() for w in range(max_workers)))
+   return results
+
+
+def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='', extract=True, overwrite=False, max_workers=8,
+                      httpURL=None, segments=4, keepZip=True, useAsync=False):
    '''Downloads a set of zip files from an FTP site.  
       The file set is determined by a list in a user-provided CSV file, which is assumed to have a header row containing field names.
    in_tab = Table (in CSV format) containing unique ID field for the files to retrieve
@@ -62,7 +353,17 @@ def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='',
    ftpHOST = FTP site
    ftpDIR = FTP directory
    pre = Filename prefix; optional
-   suf = Filename suffix; optional'''
+   suf = Filename suffix; optional
+   max_workers = Number of files to download at once, each over its own FTP connection; optional
+   httpURL = HTTPS folder containing the same files as ftpDIR. If given, files are downloaded from here, using FTP only
+      for files which fail over HTTPS; optional
+   segments = Number of byte-range segments to download at once for each file, when using httpURL; optional
+   keepZip = If False (and extract is True), zip files are deleted (or never saved) once extracted; optional
+   useAsync = If True (and httpURL is not given), FTP downloads are run from a single asyncio event loop with aioftp,
+      instead of one thread per connection. Requires aioftp; optional
+
+   When extract is True, each file is extracted to out_dir/unzip as soon as it has downloaded, so extraction of one
+   file overlaps with the download of others.'''
 
    # Create and open a log file.
    # If this log file already exists, it will be overwritten.  If it does not exist, it will be created.
@@ -80,13 +381,13 @@ def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='',
    print('Reading table...')
    try:
       with open(in_tab, 'r') as theFile:
-         reader = csv.DictReader(theFile)
-         for row in reader:
-            fname = pre + row[in_fld] + suf
-            FileList.append(fname)
+         reader = csv.reader(theFile)
+         idx = next(reader).index(in_fld)  # Position of the ID field in the header row
+         # Drop duplicate IDs, keeping the order of the table. Blank lines are skipped, as DictReader does.
+         FileList = list(dict.fromkeys(pre + row[idx] + suf for row in reader if row))
    except:
       Log.write('Unable to parse input table.  Exiting...')
-      exit()
+      sys.exit()
 
    try:
       ftp = ftplib.FTP(ftpHOST)
@@ -97,7 +398,7 @@ def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='',
       msg = 'Error: cannot reach "%s" \n' % ftpHOST
       print(msg)
       Log.write(msg)
-      exit()
+      sys.exit()
 
    try:
       ftp.login()
@@ -107,7 +408,7 @@ def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='',
       print(msg)
       Log.write(msg)
       ftp.quit()
-      exit()
+      sys.exit()
 
    try:
       ftp.cwd(ftpDIR)
@@ -117,36 +418,51 @@ def BatchDownloadZips(in_tab, in_fld, out_dir, ftpHOST, ftpDIR, pre='', suf='',
       print(msg)
       Log.write(msg)
       ftp.quit()
-      exit()
+      sys.exit()
+
+   # The connection above is only used to check the host/login/folder; downloads use one connection per thread
+   ftp.quit()
 
    # Download the files and save to the output directory, while keeping track of success/failure
-   for fileName in FileList:
+   if extract:
+      unzipDir = out_dir + os.sep + 'unzip'
+      if not os.path.exists(unzipDir):
+         os.makedirs(unzipDir)
+      print('Extracting all files to ' + unzipDir + '...')
+   else:
+      unzipDir = None
+
+   def download(fileName):
+      if httpURL:
+         try:
+            return DownloadZipHTTP(fileName, out_dir, httpURL, overwrite, segments, unzipDir, keepZip)
+         except:
+            print('HTTPS download failed for %s; trying FTP...' % fileName)
+      # A failed HTTPS attempt leaves no partial file behind, and DownloadZip re-downloads any incomplete one
+      return DownloadZip(fileName, out_dir, ftpHOST, ftpDIR, overwrite, unzipDir, keepZip)
+
+   if useAsync and aioftp is None:
+      print('aioftp is not installed; downloading with threads instead.')
+      useAsync = False
+   if useAsync and not httpURL:
+      ProcList = asyncio.run(_asyncDownloadAll(FileList, out_dir, ftpHOST, ftpDIR, overwrite, unzipDir, keepZip,
+                                               max_workers))
+   else:
       try:
-         if not os.path.exists(os.path.join(out_dir, fileName)) or overwrite:
-            with open(os.path.join(out_dir, fileName), 'wb') as local_file:
-               print('Downloading %s ...' % fileName)
-               ftp.retrbinary('RETR ' + fileName, local_file.write)
-               ProcList.append('Successfully downloaded %s' % fileName)
-         else:
-            print('Already downloaded %s ...' % fileName)
-            ProcList.append('Already downloaded %s' % fileName)
-      except:
-         ProcList.append('Failed to download %s' % fileName)
+         with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            ProcList = list(ex.map(download, FileList))
+      finally:
+         _closeAllFTP()
 
    # Write download results to log.
-   for item in ProcList:
-      Log.write("%s\n" % item)
+   Log.writelines("%s\n" % item for item in ProcList)
 
    timestamp = datetime.now().strftime(FORMAT)
    Log.write("\nProcess logging ended %s" % timestamp)
    Log.close()
 
    if extract:
-      try:
-         BatchExtractZipFiles.BatchExtractZipFiles(out_dir, out_dir + os.sep + 'unzip')
-         print('All files extracted.')
-      except:
-         print('Error unzipping files.')
+      print('Extraction finished; see %s for results.' % ProcLogFile)
 
    return
 
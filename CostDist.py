@@ -21,48 +21,465 @@
 
 # Import Helper module and functions
 from Helper import *
+import numpy as np
+import tempfile
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+try:
+   # Optional: CuPy, for filling raster blocks on a GPU (see FillNoData)
+   import cupy as cp
+except ImportError:
+   cp = None
+try:
+   # Optional: rasterio and shapely, for rasterizing roads without PolylineToRaster (see RasterizeRoads)
+   import rasterio.features
+   import rasterio.transform
+   import rasterio.windows
+   import shapely
+except ImportError:
+   rasterio = None
+try:
+   # Optional: Numba, to compile the cost distance kernel (see CostDistNumba). Without it, the kernel runs as plain
+   # Python, which is far too slow for anything but small rasters.
+   from numba import njit
+except ImportError:
+   def njit(*args, **kwargs):
+      if len(args) == 1 and callable(args[0]):
+         return args[0]
+      return lambda f: f
 
+# NoData value for fixed-point (uint16) cost surfaces (see WriteTiledTif)
+FIXEDNODATA = 65535
 
-def CostSurfTravTime(inRoads, snpRast, outCostSurf, bkgdNoData=False, valFld="TravTime", priFld="Speed_upd"):
+def _fillBlock(r, m, lowerLeft, ncols, nrows, fillVal, useGPU=False):
+   """Internal fn for FillNoData. Reads one block of raster r (and mask raster m, if given), and returns it as a
+   float32 array with NoData cells filled, and cells outside the mask set to NaN."""
+   arr = arcpy.RasterToNumPyArray(r, lowerLeft, ncols, nrows, np.nan).astype(np.float32, copy=False)
+   mask = None
+   if m is not None:
+      # Read the mask over the same cells, with its own NoData value (it may be an integer raster)
+      mask = arcpy.RasterToNumPyArray(m, lowerLeft, ncols, nrows, m.noDataValue) == m.noDataValue
+   if useGPU:
+      g = cp.asarray(arr)
+      g[cp.isnan(g)] = fillVal
+      if mask is not None:
+         g[cp.asarray(mask)] = cp.nan
+      return cp.asnumpy(g)
+   arr[np.isnan(arr)] = fillVal
+   if mask is not None:
+      arr[mask] = np.nan
+   return arr
+
+
+def FillNoData(inRast, fillVal, outRast, maskRast=None, blockSize=4096, useGPU=False):
+   """Replaces NoData cells in a raster with a constant value. This is equivalent to Con(IsNull(inRast), fillVal, inRast),
+   but is done on NumPy arrays in a single pass, instead of with map algebra.
+
+Parameters:
+- inRast: Input raster.
+- fillVal: The value assigned to NoData cells.
+- outRast: The output raster dataset.
+- maskRast: Optional raster, aligned with inRast. Cells which are NoData in maskRast are NoData in the output.
+- blockSize: The raster is processed in square blocks with this many rows/columns, to limit memory use. Blocks are
+   held in the memory workspace and mosaicked into the output, so only the output is written to disk.
+- useGPU: Boolean, default value is False. If True, fills each block on the GPU using CuPy (if installed)."""
+
+   if useGPU and cp is None:
+      printWrng('CuPy is not installed; filling raster on the CPU.')
+      useGPU = False
+   r = arcpy.Raster(inRast)
+   cellW, cellH = r.meanCellWidth, r.meanCellHeight
+   m = None
+   if maskRast:
+      m = arcpy.Raster(maskRast)
+      if m.noDataValue is None:
+         # No NoData cells, so nothing to mask
+         m = None
+
+   blocks = []
+   for x in range(0, r.width, blockSize):
+      for y in range(0, r.height, blockSize):
+         # Block lower left corner, counting rows up from the bottom of the raster
+         lowerLeft = arcpy.Point(r.extent.XMin + x * cellW, r.extent.YMin + y * cellH)
+         ncols = min(blockSize, r.width - x)
+         nrows = min(blockSize, r.height - y)
+         arr = _fillBlock(r, m, lowerLeft, ncols, nrows, fillVal, useGPU)
+         blk = arcpy.NumPyArrayToRaster(arr, lowerLeft, cellW, cellH, np.nan)
+         del arr
+         if r.width <= blockSize and r.height <= blockSize:
+            # Only one block; save it directly
+            blk.save(outRast)
+         else:
+            blkName = 'memory' + os.sep + 'fillblk_%s_%s_%s' % (os.getpid(), x, y)
+            blk.save(blkName)
+            blocks.append(blkName)
+         del blk
+
+   if blocks:
+      arcpy.MosaicToNewRaster_management(blocks, os.path.dirname(outRast), os.path.basename(outRast), r.spatialReference,
+                                         "32_BIT_FLOAT", cellW, 1)
+      garbagePickup(blocks)
+   arcpy.DefineProjection_management(outRast, r.spatialReference)
+   return outRast
+
+
+def _rasterizeTile(args):
+   """Internal fn for RasterizeRoads. Rasterizes the shapes intersecting one tile, using the tile's own transform."""
+   shapes, window, transform, fillVal = args
+   if not shapes:
+      if np.isnan(fillVal):
+         return window, None
+      return window, np.full((window.height, window.width), fillVal, np.float32)
+   arr = rasterio.features.rasterize(shapes, out_shape=(window.height, window.width), transform=transform,
+                                     fill=fillVal, dtype='float32')
+   return window, arr
+
+
+def RasterizeRoads(inRoads, snpRast, outRast, valFld="TravTime", priFld="Speed_upd", tileSize=4096, max_workers=None,
+                   fillVal=None):
+   """Rasterizes road lines with rasterio, as an alternative to PolylineToRaster_conversion. Roads are burned in
+   ascending order of the priority field, so where roads share a cell, the one with the highest priority value sets the
+   cell value. (PolylineToRaster instead uses the segment with the greatest length in the cell, with the priority field
+   only breaking ties.) The output matches the extent, cell size, and alignment of snpRast.
+
+   The grid is split into tiles, which are rasterized in parallel and written to a GeoTIFF one window at a time, so
+   the full-size array is never held in memory. A spatial index of the roads limits each tile to the roads that
+   intersect it.
+
+Parameters:
+- inRoads: Input roads feature class. It is projected on the fly to the coordinate system of snpRast, if needed.
+- snpRast: A raster used to set the output extent, cell size, and alignment.
+- outRast: The output raster, which must be a GeoTIFF (.tif) file.
+- valFld: The field used to set the output raster values. The default field is "TravTime".
+- priFld: The priority field. The default field is "Speed_upd".
+- tileSize: Width and height of the tiles, in cells. The default is 4096.
+- max_workers: Number of processes rasterizing tiles. The default (None) uses one per CPU.
+- fillVal: Optional. The value for cells without roads. The default (None) leaves them as NoData."""
+
+   r = arcpy.Raster(snpRast)
+   cellW, cellH = r.meanCellWidth, r.meanCellHeight
+   transform = rasterio.transform.from_origin(r.extent.XMin, r.extent.YMax, cellW, cellH)
+
+   # Read geometries and values, lowest priority first. The cursor projects geometries to the raster's coordinate
+   # system as it reads them (using arcpy.env.geographicTransformations, if a datum change is involved).
+   with arcpy.da.SearchCursor(inRoads, ['SHAPE@WKB', valFld], "%s IS NOT NULL" % valFld,
+                              spatial_reference=r.spatialReference, sql_clause=(None, 'ORDER BY %s' % priFld)) as sc:
+      rows = [(shapely.from_wkb(bytes(row[0])), row[1]) for row in sc if row[0] is not None]
+   geoms = [g for g, v in rows]
+   tree = shapely.STRtree(geoms)
+
+   fill = np.nan if fillVal is None else float(fillVal)
+
+   # Query the index once per tile. Sorting the hits keeps them in priority order.
+   def tiles():
+      for row in range(0, r.height, tileSize):
+         for col in range(0, r.width, tileSize):
+            w = rasterio.windows.Window(col, row, min(tileSize, r.width - col), min(tileSize, r.height - row))
+            wt = rasterio.windows.transform(w, transform)
+            box = shapely.box(*rasterio.windows.bounds(w, transform))
+            hits = np.sort(tree.query(box))
+            yield [rows[i] for i in hits], w, wt, fill
+
+   profile = dict(driver='GTiff', width=r.width, height=r.height, count=1, dtype='float32', nodata=np.nan,
+                  transform=transform, tiled=True, blockxsize=256, blockysize=256, compress='lzw', BIGTIFF='IF_SAFER')
+   with rasterio.open(outRast, 'w', **profile) as dst:
+      with ProcessPoolExecutor(max_workers=max_workers) as ex:
+         # Keep only a few tiles in flight, so finished arrays do not pile up waiting to be written
+         maxPending = 2 * (max_workers or os.cpu_count())
+         pending = set()
+         for t in tiles():
+            pending.add(ex.submit(_rasterizeTile, t))
+            if len(pending) >= maxPending:
+               done, pending = wait(pending, return_when=FIRST_COMPLETED)
+               for f in done:
+                  w, arr = f.result()
+                  if arr is not None:
+                     dst.write(arr, 1, window=w)
+         for f in as_completed(pending):
+            w, arr = f.result()
+            if arr is not None:
+               dst.write(arr, 1, window=w)
+   del rows, geoms, tree
+
+   arcpy.DefineProjection_management(outRast, r.spatialReference)
+   return outRast
+
+
+def WriteTiledTif(inTif, outTif, blockSize=256, scale=None):
+   """Rewrites a single-band GeoTIFF as a float32 GeoTIFF with square internal tiles and ZSTD compression (with the
+   floating-point predictor). Cost distance tools read cells in 2D neighborhoods, which touch a few tiles rather than
+   many full-width strips. Requires rasterio.
+
+   If scale is given, values are instead stored as 16-bit fixed-point integers (value * scale, rounded), with
+   FIXEDNODATA as NoData. This halves the size of the raster again. With the default travel time scale (1e6), values
+   up to 0.0655 minutes/meter are stored to within 0.5e-6; the slowest value used, 0.03699 (1 mph), fits.
+
+Parameters:
+- inTif: The input GeoTIFF.
+- outTif: The output GeoTIFF.
+- blockSize: Width and height of the tiles, in cells. Must be a multiple of 16. The default is 256.
+- scale: Optional. The multiplier for storing values as fixed-point integers (e.g. 1e6 for travel times)."""
+
+   with rasterio.open(inTif) as src:
+      profile = src.profile.copy()
+      profile.update(driver='GTiff', dtype='float32', tiled=True, blockxsize=blockSize, blockysize=blockSize,
+                     compress='zstd', predictor=3, BIGTIFF='IF_SAFER')
+      if scale:
+         profile.update(dtype='uint16', nodata=FIXEDNODATA, predictor=2)
+      elif src.nodata is not None:
+         profile.update(nodata=np.nan)
+      profile.pop('interleave', None)
+      with rasterio.open(outTif, 'w', **profile) as dst:
+         # Copy in output-sized windows, so the whole raster is never in memory
+         for ij, win in dst.block_windows(1):
+            arr = src.read(1, window=win, masked=True).astype('float32')
+            if scale:
+               arr = np.ma.clip(np.ma.round(arr * scale), 0, FIXEDNODATA - 1).filled(FIXEDNODATA).astype('uint16')
+            else:
+               arr = arr.filled(np.nan) if src.nodata is not None else arr.data
+            dst.write(arr, 1, window=win)
+   return outTif
+
+
+def CostSurfTravTime(inRoads, snpRast, outCostSurf, bkgdNoData=False, valFld="TravTime", priFld="Speed_upd", useGPU=False,
+                     useRasterio=False, scale=None):
    """Creates a cost surface from road segments based on the TravTime field, which represents time, in minutes, to travel 1 meter at the posted road speed. Areas with no roads are assumed to allow walking speed of 3 miles/hour, equivalent to a TravTime value of  0.01233.
    
 Parameters:
 - inRoads: Input roads feature class. This should have been produced by running the sequence of functions in the ProcRoads.py module.
 - snpRast: A raster used as a processing mask and to set cell size and alignment. This could be an NLCD raster resampled to 5-m cells, for example.
-- outCostSurf: The output raster dataset.
+- outCostSurf: The output raster dataset. If this is a GeoTIFF (.tif) and rasterio is installed, it is written with square internal tiles (see WriteTiledTif).
 - bkgdNoData: Boolean, default value is False. If True, the background value is NoData; if False, it is set to a walking speed value.
 - valFld: The field used to set the output raster values. The default field is "TravTime".
 - priFld: The priority field, used to determine which road segment to use to assign cell values in cases of conflict. The default field is "Speed_upd".
+- useGPU: Boolean, default value is False. If True, the background fill is done on the GPU using CuPy (if installed).
+- useRasterio: Boolean, default value is False. If True, lines are rasterized with RasterizeRoads (requires rasterio and shapely) instead of PolylineToRaster. See RasterizeRoads for how this differs in assigning cell values.
+- scale: Optional. For a GeoTIFF output, stores values as 16-bit fixed-point integers with this multiplier (e.g. 1e6; see WriteTiledTif). Use the same scale in CostDistNumba.
 
 This function was adapted from ModelBuilder tools created by Kirsten R. Hazler and Tracy Tien for the Development Vulnerability Model (2015)"""
 
-   # Ensure inputs are in same coordinate system
-   printMsg('Checking coordinate systems of inputs...')
-   prjRoads = ProjectToMatch(inRoads, snpRast)
+   if useRasterio and rasterio is None:
+      printWrng('rasterio/shapely are not installed; rasterizing with PolylineToRaster.')
+      useRasterio = False
+
+   # Ensure inputs are in same coordinate system. RasterizeRoads projects geometries as it reads them, so a projected
+   # copy of the roads is only needed for PolylineToRaster.
+   if not useRasterio:
+      printMsg('Checking coordinate systems of inputs...')
+      prjRoads = ProjectToMatch(inRoads, snpRast)
 
    # Rasterize lines
    printMsg('Rasterizing lines...')
-   tmpRast = outCostSurf + '0'
-   arcpy.PolylineToRaster_conversion(prjRoads, valFld, tmpRast, "MAXIMUM_LENGTH", priFld, snpRast)
+   if useRasterio:
+      # rasterio writes to files, so this intermediate goes to the scratch folder
+      tmpRast = os.path.join(arcpy.env.scratchFolder, 'tmpRast_%s_%s.tif' % (os.getpid(), os.path.basename(outCostSurf)))
+      # Roads are burned straight onto the background value, so no separate fill pass is needed
+      RasterizeRoads(inRoads, snpRast, tmpRast, valFld, priFld, fillVal=None if bkgdNoData else 0.01233)
+   else:
+      # The rasterized lines are only an intermediate, so keep them in memory. The name is unique per process and output.
+      tmpRast = 'memory' + os.sep + 'tmpRast_%s_%s' % (os.getpid(), os.path.basename(outCostSurf))
+      arcpy.PolylineToRaster_conversion(prjRoads, valFld, tmpRast, "MAXIMUM_LENGTH", priFld, snpRast)
 
    # Set time costs for non-roads to finalize cost surface
    printMsg('Creating final cost surface...')
-   if bkgdNoData:
-      # bkgdNoData has only highways/ramps, so no background value is needed
+   # A GeoTIFF output is first written by ArcGIS to the scratch folder, then re-tiled into place
+   tiledOut = outCostSurf.lower().endswith('.tif') and rasterio is not None
+   if tiledOut:
+      finalRast = os.path.join(arcpy.env.scratchFolder, 'costSurf_%s_%s' % (os.getpid(), os.path.basename(outCostSurf)))
+   else:
+      finalRast = outCostSurf
+   if bkgdNoData or useRasterio:
+      # bkgdNoData has only highways/ramps, so no background value is needed. RasterizeRoads already set it otherwise.
       cs = ExtractByMask(tmpRast, snpRast)
+      cs.save(finalRast)
+      del cs
    else:
-      cs = Con(IsNull(tmpRast), 0.01233, tmpRast)
-   cs.save(outCostSurf)
+      FillNoData(tmpRast, 0.01233, finalRast, snpRast, useGPU=useGPU)
+   if tiledOut:
+      printMsg('Writing tiled GeoTIFF...')
+      WriteTiledTif(finalRast, outCostSurf, scale=scale)
    # Cleanup
-   try:
-      arcpy.Delete_management(tmpRast)
-   except:
-      printMsg('Attempted cleanup, but unable to delete %s.' % tmpRast)
+   for t in [tmpRast, finalRast] if tiledOut else [tmpRast]:
+      try:
+         arcpy.Delete_management(t)
+      except:
+         printMsg('Attempted cleanup, but unable to delete %s.' % t)
 
    printMsg('Mission accomplished.')
    return outCostSurf
 
 
+@njit(cache=True)
+def _heapPush(hCost, hIdx, n, cost, idx):
+   """Internal fn for _costDistKernel. Pushes an item onto an array-backed binary min-heap holding n items; returns
+   the new size."""
+   i = n
+   hCost[i] = cost
+   hIdx[i] = idx
+   while i > 0:
+      p = (i - 1) // 2
+      if hCost[p] <= hCost[i]:
+         break
+      hCost[p], hCost[i] = hCost[i], hCost[p]
+      hIdx[p], hIdx[i] = hIdx[i], hIdx[p]
+      i = p
+   return n + 1
+
+
+@njit(cache=True)
+def _heapPop(hCost, hIdx, n):
+   """Internal fn for _costDistKernel. Removes the smallest item from an array-backed binary min-heap holding n
+   items. Returns the item's cost and index; the heap size is then n - 1."""
+   cost = hCost[0]
+   idx = hIdx[0]
+   n -= 1
+   hCost[0] = hCost[n]
+   hIdx[0] = hIdx[n]
+   i = 0
+   while True:
+      l = 2 * i + 1
+      if l >= n:
+         break
+      c = l
+      if l + 1 < n and hCost[l + 1] < hCost[l]:
+         c = l + 1
+      if hCost[i] <= hCost[c]:
+         break
+      hCost[c], hCost[i] = hCost[i], hCost[c]
+      hIdx[c], hIdx[i] = hIdx[i], hIdx[c]
+      i = c
+   return cost, idx
+
+
+@njit(cache=True)
+def _costDistKernel(friction, sources, cellSize, maxCost, scale, barrier):
+   """Internal fn for CostDistNumba. Multi-source Dijkstra over an 8-connected grid, as in ArcGIS CostDistance: moving
+   between adjacent cells costs the distance between their centers times the mean of their friction values. Friction
+   values are multiplied by scale, so that they can be stored as fixed-point integers. Cells equal to barrier, or NaN,
+   are barriers. Cells which cannot be reached, or only at a cost above maxCost, are NaN."""
+   nrows, ncols = friction.shape
+   dist = np.full(friction.shape, np.inf)
+   done = np.zeros(friction.shape, np.bool_)
+   # The heap starts with room for one entry per cell, and is doubled if it fills up (cells can be pushed more than once)
+   hCost = np.empty(nrows * ncols + 1, np.float64)
+   hIdx = np.empty(nrows * ncols + 1, np.int64)
+   n = 0
+   for r in range(nrows):
+      for c in range(ncols):
+         f = friction[r, c]
+         if sources[r, c] and f == f and f != barrier:
+            dist[r, c] = 0.0
+            n = _heapPush(hCost, hIdx, n, 0.0, r * ncols + c)
+   dr = (-1, -1, -1, 0, 0, 1, 1, 1)
+   dc = (-1, 0, 1, -1, 1, -1, 0, 1)
+   diag = cellSize * np.sqrt(2.0)
+   while n > 0:
+      cost, idx = _heapPop(hCost, hIdx, n)
+      n -= 1
+      r = idx // ncols
+      c = idx % ncols
+      if done[r, c]:
+         continue
+      done[r, c] = True
+      for k in range(8):
+         rr = r + dr[k]
+         cc = c + dc[k]
+         if rr < 0 or rr >= nrows or cc < 0 or cc >= ncols or done[rr, cc]:
+            continue
+         f = friction[rr, cc]
+         if f != f or f == barrier:
+            continue
+         if dr[k] != 0 and dc[k] != 0:
+            step = diag
+         else:
+            step = cellSize
+         newCost = cost + step * 0.5 * scale * (np.float64(friction[r, c]) + np.float64(f))
+         if newCost < dist[rr, cc] and newCost <= maxCost:
+            dist[rr, cc] = newCost
+            if n == hCost.shape[0]:
+               hCost = np.concatenate((hCost, np.empty(n, np.float64)))
+               hIdx = np.concatenate((hIdx, np.empty(n, np.int64)))
+            n = _heapPush(hCost, hIdx, n, newCost, rr * ncols + cc)
+   out = np.full(friction.shape, np.nan, np.float32)
+   for r in range(nrows):
+      for c in range(ncols):
+         if done[r, c]:
+            out[r, c] = dist[r, c]
+   return out
+
+
+def CostDistNumba(costSurf, sources, outRast, maxCost=None, scale=None):
+   """Calculates accumulated travel cost (e.g. minutes) from a set of sources over a cost surface, such as one made by
+   CostSurfTravTime. This is an alternative to arcpy's CostDistance, using a multi-source Dijkstra search compiled with
+   Numba (if installed). The whole cost surface is read into memory.
+
+Parameters:
+- costSurf: Input cost surface raster. NoData cells are barriers.
+- sources: Source locations. Either a raster aligned with costSurf (all cells with data are sources), or a feature class
+   (which is rasterized to match costSurf).
+- outRast: The output accumulated cost raster.
+- maxCost: Optional. Cells with an accumulated cost above this value are NoData, and the search stops there.
+- scale: Optional. For a fixed-point cost surface (see WriteTiledTif), the scale factor it was written with. The
+   surface is then kept in memory as 16-bit integers rather than floats."""
+
+   r = arcpy.Raster(costSurf)
+   lowerLeft = arcpy.Point(r.extent.XMin, r.extent.YMin)
+   cellSize = r.meanCellWidth
+   # Single precision is ample for friction values, and halves the memory the search reads from
+   if scale:
+      friction = arcpy.RasterToNumPyArray(r, nodata_to_value=FIXEDNODATA).astype(np.uint16, copy=False)
+      mult, barrier = 1.0 / scale, FIXEDNODATA
+   else:
+      friction = arcpy.RasterToNumPyArray(r, nodata_to_value=np.nan).astype(np.float32, copy=False)
+      mult, barrier = 1.0, np.nan
+
+   desc = arcpy.Describe(sources)
+   if desc.dataType in ('FeatureClass', 'FeatureLayer', 'ShapeFile'):
+      printMsg('Rasterizing sources...')
+      srcRast = 'memory' + os.sep + 'srcRast_%s' % os.getpid()
+      with arcpy.EnvManager(snapRaster=costSurf, cellSize=costSurf, extent=costSurf):
+         arcpy.FeatureToRaster_conversion(sources, desc.OIDFieldName, srcRast, cellSize)
+   else:
+      srcRast = sources
+   s = arcpy.Raster(srcRast)
+   srcNoData = s.noDataValue if s.noDataValue is not None else -9999
+   srcArr = arcpy.RasterToNumPyArray(s, lowerLeft, r.width, r.height, srcNoData) != srcNoData
+   if srcRast != sources:
+      garbagePickup([srcRast])
+
+   printMsg('Calculating cost distance...')
+   if maxCost is None:
+      maxCost = np.inf
+   out = _costDistKernel(friction, srcArr, float(cellSize), float(maxCost), mult, barrier)
+   del friction, srcArr
+   outR = arcpy.NumPyArrayToRaster(out, lowerLeft, cellSize, r.meanCellHeight, np.nan)
+   outR.save(outRast)
+   arcpy.DefineProjection_management(outRast, r.spatialReference)
+   printMsg('Mission accomplished.')
+   return outRast
+
+
+def _initCostWorker(snpRast, scratchDir):
+   """Internal fn for main. Sets up processing environments in a worker process (these are not inherited from the
+   parent process), including a scratch workspace of its own so that temporary files from different workers do not
+   collide."""
+   arcpy.env.extent = snpRast
+   arcpy.env.snapRaster = snpRast
+   arcpy.env.cellSize = snpRast
+   arcpy.env.mask = snpRast
+   arcpy.env.overwriteOutput = True
+   wsp = os.path.join(scratchDir, 'scratch_%s' % os.getpid())
+   if not os.path.exists(wsp):
+      os.makedirs(wsp)
+   arcpy.env.scratchWorkspace = wsp
+   return
+
+
+def _costSurfJob(args):
+   """Internal fn for main. Runs CostSurfTravTime with a tuple of arguments (inRoads, snpRast, outCostSurf, bkgdNoData)."""
+   return CostSurfTravTime(*args)
+
+
 ############################################################################
 
 # Use the section below to enable a function (or sequence of functions) to be run directly from this free-standing script (i.e., not as an ArcGIS toolbox tool)
@@ -87,35 +504,48 @@ def main():
    inRoads = os.path.join(inGDB, 'all_subset')
 
 
-   ## Make cost surfaces
+   ## Select roads for cost surfaces
    # NOTE: both surfaces should include ramps (RmpHwy = 1)
    # LAH-only cost surface
-   roadSub = os.path.join(inGDB, 'all_subset_only_lah')
-   arcpy.Select_analysis(inRoads, roadSub, "RmpHwy <> 0")
-   outCostSurf = outGDB + os.sep + 'costSurf_only_lah'
-   CostSurfTravTime(roadSub, snpRast, outCostSurf, bkgdNoData=True)
+   roadSub_lah = os.path.join(inGDB, 'all_subset_only_lah')
+   arcpy.Select_analysis(inRoads, roadSub_lah, "RmpHwy <> 0")
    # no-LAH cost surface
-   roadSub = os.path.join(inGDB, 'all_subset_no_lah')
-   arcpy.Select_analysis(inRoads, roadSub, "RmpHwy <> 2")
-   outCostSurf = outGDB + os.sep + 'costSurf_no_lah'
-   CostSurfTravTime(roadSub, snpRast, outCostSurf)
-
-
-   ## Make walking cost surface-on local roads only: Walkable roads include everything except LAH/ramps
+   roadSub_nolah = os.path.join(inGDB, 'all_subset_no_lah')
+   arcpy.Select_analysis(inRoads, roadSub_nolah, "RmpHwy <> 2")
+   # Walking cost surface-on local roads only: Walkable roads include everything except LAH/ramps
    inRoads1 = os.path.join(inGDB, 'all_centerline_urbAdjust')
    inRoads = os.path.join(inGDB, 'all_centerline_walkable')
    arcpy.Select_analysis(inRoads1, inRoads, "rmpHwy = 0 AND RTTYP <> 'I'")
-   outCostSurf = outGDB + os.sep + 'walkRoads'
-   CostSurfTravTime(inRoads, snpRast, outCostSurf, bkgdNoData=True)
-   # Make background values for walking (excluding areas of LAH as nodata areas in the walk raster)
-   lah = outGDB + os.sep + 'costSurf_only_lah'
-   Con(IsNull(lah), 0.03699, None).save(outGDB + os.sep + 'crawl')
+
+   ## Make the three cost surfaces at the same time, each in its own process
+   # Each worker writes to a GDB of its own (file GDBs do not support concurrent writers), on a local disk (the system
+   # temp folder) rather than the project drive, which may be a network share. Results are copied to outGDB after.
+   tmpDir = tempfile.mkdtemp()
+   tmpGDB = {}
+   for nm in ['costSurf_only_lah', 'costSurf_no_lah', 'walkRoads']:
+      tmpGDB[nm] = os.path.join(tmpDir, nm + '.gdb')
+      arcpy.CreateFileGDB_management(tmpDir, nm + '.gdb')
+   outCostSurf = os.path.join(tmpGDB['walkRoads'], 'walkRoads')
+   jobs = [(roadSub_lah, snpRast, os.path.join(tmpGDB['costSurf_only_lah'], 'costSurf_only_lah'), True),
+           (roadSub_nolah, snpRast, os.path.join(tmpGDB['costSurf_no_lah'], 'costSurf_no_lah'), False),
+           (inRoads, snpRast, outCostSurf, True)]
+   with ProcessPoolExecutor(max_workers=len(jobs), initializer=_initCostWorker,
+                            initargs=(snpRast, tmpDir)) as ex:
+      list(ex.map(_costSurfJob, jobs))
+   for nm in ['costSurf_only_lah', 'costSurf_no_lah']:
+      arcpy.CopyRaster_management(os.path.join(tmpGDB[nm], nm), outGDB + os.sep + nm)
+
    # Final walking cost surface raster is: NoData on LAH roads, 3 MPH on all other roads, and 1 MPH in all other areas
-   Con(IsNull(outCostSurf), outGDB + os.sep + 'crawl', 0.01233).save(outGDB + os.sep + 'costSurf_walk')
+   # Background values for walking (excluding areas of LAH as nodata areas) are made in the same expression, so the
+   # raster is written in one pass.
+   lah = outGDB + os.sep + 'costSurf_only_lah'
+   Con(IsNull(outCostSurf), Con(IsNull(lah), 0.03699), 0.01233).save(outGDB + os.sep + 'costSurf_walk')
 
 
    ## clean up
-   garbagePickup([outGDB + os.sep + 'walkRoads', outGDB + os.sep + 'crawl'])
+   # The intermediate walkRoads surface was only ever written to its scratch GDB
+   garbagePickup(list(tmpGDB.values()))
+   shutil.rmtree(tmpDir, ignore_errors=True)
    # Build pyramids for all rasters
    arcpy.BuildPyramidsandStatistics_management(outGDB)
 
@@ -14,37 +14,63 @@ import arcpy
 import os
 import sys
 import traceback
+import WorkerExe  # sets the worker process executable for process pools
+import hashlib
+import numpy as np
 from datetime import datetime as datetime
 arcpy.CheckOutExtension("Spatial")
 from arcpy.sa import *
+try:
+   # Optional: scikit-learn, for clustering points in memory (see SpatialCluster)
+   from sklearn.cluster import DBSCAN
+except ImportError:
+   DBSCAN = None
 
 scratchGDB = arcpy.env.scratchGDB
 arcpy.env.overwriteOutput = True
+# Let tools that support it (e.g. Dissolve, Buffer, most Spatial Analyst tools) use all cores
+arcpy.env.parallelProcessingFactor = "100%"
+# Set Helper.VERBOSE = False to silence progress messages from printMsg in batch runs. Warnings and errors still print.
+VERBOSE = True
 
 
 def countFeatures(features):
    '''Gets count of features'''
-   count = int((arcpy.GetCount_management(features)).getOutput(0))
+   # For a layer with a selection, the selected IDs are already listed in its FIDSet, so no cursor is needed
+   try:
+      fidSet = arcpy.Describe(features).FIDSet
+   except (AttributeError, OSError, IOError):
+      fidSet = None
+   if fidSet:
+      return fidSet.count(';') + 1
+   count = int(arcpy.management.GetCount(features)[0])
    return count
    
 def garbagePickup(trashList):
    '''Deletes Arc files in list, with error handling. Argument must be a list.'''
-   for t in trashList:
-      try:
-         arcpy.Delete_management(t)
-      except:
-         pass
+   # Delete everything in one call; if that fails (e.g. an item does not exist), retry the items one at a time
+   try:
+      arcpy.Delete_management(trashList)
+   except:
+      for t in trashList:
+         try:
+            arcpy.Delete_management(t)
+         except:
+            pass
    return      
       
 def GetElapsedTime (t1, t2):
    """Gets the time elapsed between the start time (t1) and the finish time (t2)."""
    delta = t2 - t1
-   (d, m, s) = (delta.days, delta.seconds/60, delta.seconds%60)
-   (h, m) = (m/60, m%60)
+   (m, s) = divmod(int(delta.total_seconds()), 60)
+   (h, m) = divmod(m, 60)
+   (d, h) = divmod(h, 24)
    deltaString = '%s days, %s hours, %s minutes, %s seconds' % (str(d), str(h), str(m), str(s))
    return deltaString
 
 def printMsg(msg):
+   if not VERBOSE:
+      return
    arcpy.AddMessage(msg)
    print(msg)
    return
@@ -59,6 +85,8 @@ def printErr(msg):
    print('Error: ' + msg)
    return
    
+_transCache = {}
+
 def ProjectToMatch (fcTarget, csTemplate):
    """Project a target feature class to match the coordinate system of a template dataset"""
    # Get the spatial reference of your target and template feature classes
@@ -70,13 +98,16 @@ def ProjectToMatch (fcTarget, csTemplate):
    gcsTemplate = srTemplate.GCS
 
    # Compare coordinate systems and decide what to do from there. 
-   if srTarget.Name == srTemplate.Name:
+   # Matching factory (WKID) codes catch identical systems whose names differ; a code of 0 means a custom system.
+   sameCode = srTarget.factoryCode != 0 and srTarget.factoryCode == srTemplate.factoryCode
+   if sameCode or srTarget.Name == srTemplate.Name:
       printMsg('Coordinate systems match; no need to do anything.')
       return fcTarget
    else:
       printMsg('Coordinate systems do not match; proceeding with re-projection.')
-      if fcTarget[-3:] == 'shp':
-         fcTarget_prj = fcTarget[:-4] + "_prj.shp"
+      base, ext = os.path.splitext(fcTarget)
+      if ext.lower() == '.shp':
+         fcTarget_prj = base + "_prj" + ext
       else:
          fcTarget_prj = fcTarget + "_prj"
       if gcsTarget.Name == gcsTemplate.Name:
@@ -85,8 +116,11 @@ def ProjectToMatch (fcTarget, csTemplate):
       else:
          printMsg('Datums do not match; re-projecting with geographic transformation')
          # Get the list of applicable geographic transformations
-         # This is a stupid long list
-         transList = arcpy.ListTransformations(srTarget,srTemplate) 
+         # This is a stupid long list, so it is only built once per pair of datums
+         key = (gcsTarget.Name, gcsTemplate.Name)
+         if key not in _transCache:
+            _transCache[key] = arcpy.ListTransformations(srTarget,srTemplate)
+         transList = _transCache[key]
          # Extract the first item in the list, assumed the appropriate one to use
          geoTrans = transList[0]
          # Now perform reprojection with geographic transformation
@@ -95,53 +129,42 @@ def ProjectToMatch (fcTarget, csTemplate):
       return fcTarget_prj
 
 def TabToDict(inTab, fldKey, fldValue):
-   '''Converts two fields in a table to a dictionary'''
-   codeDict = {}
-   with arcpy.da.SearchCursor(inTab, [fldKey, fldValue]) as sc:
-      for row in sc:
-         key = sc[0]
-         val = sc[1]
-         codeDict[key] = val
-   return codeDict      
+   '''Converts two fields in a table to a dictionary. Null strings become empty strings.'''
+   # Read both fields into an array in one call, rather than row by row. Numeric fields containing nulls cannot be
+   # read this way, so those fall back to a cursor.
+   strFlds = [f.name for f in arcpy.ListFields(inTab) if f.name in (fldKey, fldValue) and f.type == 'String']
+   try:
+      nulls = dict((f, '') for f in strFlds) or None
+      arr = arcpy.da.TableToNumPyArray(inTab, [fldKey, fldValue], null_value=nulls)
+      return dict(zip(arr[fldKey].tolist(), arr[fldValue].tolist()))
+   except (RuntimeError, TypeError, ValueError):
+      with arcpy.da.SearchCursor(inTab, [fldKey, fldValue]) as sc:
+         return dict((row[0], row[1]) for row in sc)
 
-def JoinFields(ToTab, fldToJoin, FromTab, fldFromJoin, addFields):
-   '''An alternative to arcpy's JoinField_management, which is unbearably slow.
+def _distToUnits(dist, sr):
+   '''Internal fn for SpatialCluster. Converts a linear distance string such as "250 METERS" to the units of a 
+   spatial reference. A bare number is assumed to already be in those units. Returns None if the distance cannot be 
+   converted (a geographic coordinate system, or a unit not listed here), so the caller can use another method.'''
+   toMeters = {'METERS': 1.0, 'KILOMETERS': 1000.0, 'DECIMETERS': 0.1, 'CENTIMETERS': 0.01, 'MILLIMETERS': 0.001,
+               'FEET': 0.3048, 'INCHES': 0.0254, 'YARDS': 0.9144, 'MILES': 1609.344, 'NAUTICALMILES': 1852.0}
+   if sr.type == 'Geographic':
+      return None
+   parts = str(dist).split()
+   if len(parts) == 1:
+      return float(parts[0])
+   if len(parts) != 2 or parts[1].upper() not in toMeters:
+      return None
+   return float(parts[0]) * toMeters[parts[1].upper()] / sr.metersPerUnit
 
-   Further testing has revealed that sometimes this alternative method is much much worse. YMMV.
-   
-   ToTab = The table to which fields will be added
-   fldToJoin = The key field in ToTab, used to match records in FromTab
-   FromTab = The table from which fields will be copied
-   fldFromJoin = the key field in FromTab, used to match records in ToTab
-   addFields = the list of fields to be added'''
-   
-   codeblock = '''def getFldVal(srcID, fldDict):
-      try:
-         fldVal = fldDict[srcID]
-      except:
-         fldVal = None
-      return fldVal'''
-   
-   for fld in addFields:
-      printMsg('Working on "%s" field...' %fld)
-      fldObject = arcpy.ListFields(FromTab, fld)[0]
-      fldDict = TabToDict(FromTab, fldFromJoin, fld)
-      printMsg('Established data dictionary.')
-      expression = 'getFldVal(!%s!, %s)' % (fldToJoin, fldDict)
-      srcFields = arcpy.ListFields(ToTab, fld)
-      if len(srcFields) == 0:
-         arcpy.AddField_management (ToTab, fld, fldObject.type, '', '', fldObject.length)
-      printMsg('Calculating... This can take a long time for large datasets...')
-      arcpy.CalculateField_management (ToTab, fld, expression, 'PYTHON', codeblock)
-      printMsg('"%s" field done.' %fld)
-   return ToTab
-   
 def SpatialCluster (inFeats, fldID, searchDist, fldGrpID = 'grpID'):
    '''Clusters features based on specified search distance. Features within twice the search distance of each other will be assigned to the same group.
    inFeats = The input features to group
    fldID = The field containing unique feature IDs in inFeats
    searchDist = The search distance to use for clustering. This should be half of the max distance allowed to include features in the same cluster. E.g., if you want features within 500 m of each other to cluster, enter "250 METERS"
-   fldGrpID = The desired name for the output grouping field. If not specified, it will be "grpID".'''
+   fldGrpID = The desired name for the output grouping field. If not specified, it will be "grpID".
+   
+   Point features are clustered in memory with DBSCAN if scikit-learn is installed; otherwise, and for lines and 
+   polygons, features are grouped by buffering, exploding, and spatially joining.'''
    
    # Initialize trash items list
    trashList = []
@@ -151,16 +174,36 @@ def SpatialCluster (inFeats, fldID, searchDist, fldGrpID = 'grpID'):
       arcpy.DeleteField_management (inFeats, fldGrpID)
    except:
       pass
+   
+   # For points, grouping by touching buffers is the same as single-linkage clustering within twice the search
+   # distance, which DBSCAN with min_samples=1 does in memory, without any scratch feature classes.
+   desc = arcpy.Describe(inFeats)
+   dist = _distToUnits(searchDist, desc.spatialReference) if desc.shapeType == 'Point' else None
+   if dist is not None and DBSCAN is not None:
+      printMsg('Clustering points in memory')
+      eps = 2 * dist
+      arr = arcpy.da.FeatureClassToNumPyArray(inFeats, ['OID@', 'SHAPE@X', 'SHAPE@Y'], skip_nulls=True)
+      xy = np.column_stack((arr['SHAPE@X'], arr['SHAPE@Y']))
+      labels = DBSCAN(eps=eps, min_samples=1, algorithm='ball_tree').fit_predict(xy)
+      # Start group IDs at 1, like the OBJECTIDs used by the buffer method
+      grpDict = dict(zip(arr['OID@'].tolist(), (labels + 1).tolist()))
+      arcpy.AddField_management (inFeats, fldGrpID, 'LONG')
+      with arcpy.da.UpdateCursor(inFeats, ['OID@', fldGrpID]) as uc:
+         for row in uc:
+            row[1] = grpDict.get(row[0])
+            uc.updateRow(row)
+      printMsg('Processing complete.')
+      return inFeats
       
    # Buffer input features
    printMsg('Buffering input features')
-   outBuff = scratchGDB + os.sep + 'outBuff'
+   outBuff = 'memory' + os.sep + 'outBuff'
    arcpy.Buffer_analysis (inFeats, outBuff, searchDist, '', '', 'ALL')
    trashList.append(outBuff)
    
    # Explode multipart  buffers
    printMsg('Exploding buffers')
-   explBuff = scratchGDB + os.sep + 'explBuff'
+   explBuff = 'memory' + os.sep + 'explBuff'
    arcpy.MultipartToSinglepart_management (outBuff, explBuff)
    trashList.append(explBuff)
    
@@ -171,13 +214,13 @@ def SpatialCluster (inFeats, fldID, searchDist, fldGrpID = 'grpID'):
    
    # Spatial join buffers with input features
    printMsg('Performing spatial join between buffers and input features')
-   joinFeats = scratchGDB + os.sep + 'joinFeats'
+   joinFeats = 'memory' + os.sep + 'joinFeats'
    arcpy.SpatialJoin_analysis (inFeats, explBuff, joinFeats, 'JOIN_ONE_TO_ONE', 'KEEP_ALL', '', 'WITHIN')
    trashList.append(joinFeats)
    
    # Join grpID field to input features
    # This employs a custom function because arcpy is stupid slow at this
-   JoinFields(inFeats, fldID, joinFeats, 'TARGET_FID', [fldGrpID])
+   JoinFast(inFeats, fldID, joinFeats, 'TARGET_FID', [fldGrpID])
    
    # Cleanup: delete buffers, spatial join features
    garbagePickup(trashList)
@@ -203,8 +246,15 @@ def tbackInLoop():
 def unique_values(table, field):
    ''' Gets list of unique values in a field.
    Thanks, ArcPy Cafe! https://arcpy.wordpress.com/2012/02/01/create-a-list-of-unique-field-values/'''
-   with arcpy.da.SearchCursor(table, [field]) as cursor:
-      return sorted({row[0] for row in cursor})
+   # numpy.unique sorts and de-duplicates in one call, without building a Python object per row. As in TabToDict, 
+   # null strings become empty strings, and a numeric field containing nulls falls back to a cursor.
+   isStr = [f.type for f in arcpy.ListFields(table, field)] == ['String']
+   try:
+      arr = arcpy.da.TableToNumPyArray(table, [field], null_value={field: ''} if isStr else None)
+      return np.unique(arr[field]).tolist()
+   except (RuntimeError, TypeError, ValueError):
+      with arcpy.da.SearchCursor(table, [field]) as cursor:
+         return sorted({row[0] for row in cursor})
 
 
 def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
@@ -225,29 +275,30 @@ def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
 
    if type(JoinFlds) != list:
       JoinFlds = [JoinFlds]
-   flds_info = [a for a in arcpy.ListFields(FromTab) if a.name in JoinFlds]
+   # List the fields of each table once, and look them up by name
+   fromFlds = dict((a.name, a) for a in arcpy.ListFields(FromTab))
+   flds_info = [fromFlds[j] for j in JoinFlds if j in fromFlds]
    if len(flds_info) == 0:
       print('No fields found, no changes made.')
       return ToTab
    else:
       flds = [f.name for f in flds_info]
       print('Joining [' + ', '.join(flds) + ']...')
-   r = list(range(1, len(JoinFlds) + 1))
+   r = list(range(1, len(flds) + 1))
    joindict = {}
    with arcpy.da.SearchCursor(FromTab, [FromFld] + flds) as rows:
       for row in rows:
-         joinval = row[0]
-         joindict[joinval] = [row[a] for a in r]
-   del row, rows
-   tFlds = [a.name for a in arcpy.ListFields(ToTab)]
+         joindict[row[0]] = row[1:]
+   del rows
+   tFlds = set(a.name for a in arcpy.ListFields(ToTab))
    # Add fields
-   for j in JoinFlds:
-      ft = [a.type for a in flds_info if a.name == j][0]
+   for f in flds_info:
+      j = f.name
       if j in tFlds:
          arcpy.DeleteField_management(ToTab, j)
-      if ft == 'String':
+      if f.type == 'String':
          arcpy.AddField_management(ToTab, j, "TEXT", field_length=8000)
-      elif ft == 'Integer':
+      elif f.type == 'Integer':
          arcpy.AddField_management(ToTab, j, "LONG")
       else:
          arcpy.AddField_management(ToTab, j, "DOUBLE")
@@ -259,10 +310,74 @@ def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
             for a in r:
                rec[a] = joindict[keyval][a - 1]
             recs.updateRow(rec)
-   del rec, recs
+   del recs
    return ToTab
 
 
+def _dataStamp(path):
+   '''Internal fn for cachedStep. Gets a stamp of a dataset's current state. For a dataset stored as its own files 
+   (e.g. a shapefile), this is the latest modification time of those files, ignoring lock files. Datasets in a 
+   geodatabase share its files with everything else there, so for tables and feature classes the stamp is a hash of 
+   the content (all attribute values and geometries), and for other datasets (e.g. rasters) it is the extent.'''
+   p = str(path)
+   if os.path.isfile(p):
+      d = os.path.dirname(p) or os.curdir
+      name = os.path.splitext(os.path.basename(p))[0].lower()
+      return max([os.path.getmtime(p)] + [e.stat().st_mtime for e in os.scandir(d) if e.is_file()
+                                          and e.name.lower().startswith(name + '.')
+                                          and not e.name.lower().endswith('.lock')])
+   if not arcpy.Exists(p):
+      return None
+   desc = arcpy.Describe(p)
+   if hasattr(desc, 'fields'):
+      flds = [f.name for f in desc.fields if f.type not in ('Geometry', 'Blob', 'Raster')]
+      if hasattr(desc, 'shapeType'):
+         flds.append('SHAPE@WKB')
+      h = hashlib.sha1(repr(flds).encode('utf-8'))
+      with arcpy.da.SearchCursor(p, flds) as sc:
+         for row in sc:
+            h.update(repr(row).encode('utf-8'))
+      return h.hexdigest()
+   if hasattr(desc, 'extent'):
+      ext = desc.extent
+      return (ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+   return None
+
+def cachedStep(func, inputs, outData, *args, **kwargs):
+   '''Runs func(*args, **kwargs) to create outData, unless outData already exists from an earlier run with the same
+   inputs (by their state; see _dataStamp), function, and arguments. The key for each run is stored in a '_cache' 
+   folder next to the output's workspace.
+   
+   func = The function to run
+   inputs = The list of input datasets. A change to any of them forces a rerun.
+   outData = The output dataset created by func
+   args, kwargs = The arguments to func, which should include outData'''
+   
+   if type(inputs) != list:
+      inputs = [inputs]
+   def runKey():
+      keyStr = repr([func.__name__, [(str(i), _dataStamp(i)) for i in inputs], args, sorted(kwargs.items())])
+      return hashlib.sha1(keyStr.encode('utf-8')).hexdigest()
+   wsp = os.path.dirname(str(outData))
+   cacheDir = os.path.join(os.path.dirname(wsp) if wsp.lower().endswith('.gdb') else wsp, '_cache')
+   keyFile = os.path.join(cacheDir, os.path.basename(wsp) + '_' + os.path.basename(str(outData)) + '.key')
+   
+   if arcpy.Exists(outData) and os.path.exists(keyFile):
+      with open(keyFile) as f:
+         if f.read() == runKey():
+            printMsg('Inputs unchanged; using existing %s.' % outData)
+            return outData
+   # Drop the old key first, so that if the step fails partway (after overwriting outData), the next run redoes it
+   if os.path.exists(keyFile):
+      os.remove(keyFile)
+   result = func(*args, **kwargs)
+   # The key is taken after the step, so it describes the inputs as the next run will find them
+   if not os.path.exists(cacheDir):
+      os.makedirs(cacheDir)
+   with open(keyFile, 'w') as f:
+      f.write(runKey())
+   return result
+
 def copyDomains(inTab, srcTab):
    print("Assigning domains...")
    flds = [a for a in arcpy.ListFields(srcTab) if a.domain != '']
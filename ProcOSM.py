@@ -22,7 +22,16 @@
 import arcpy
 import time
 import os
+import numpy as np
+import tempfile
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from ProcRoads import CalcRoadDensity
+try:
+   # Optional: shapely, for finding roads in urban areas with an in-memory spatial index (see prepOSM)
+   import shapely
+except ImportError:
+   shapely = None
 arcpy.env.overwriteOutput = True
 
 
@@ -36,63 +45,41 @@ def rmpHwy(code):
       return 0
 
 
+# Road codes (OSM fclass codes) for driving roads, and the base speed (MPH) for each code. Codes not listed get -1.
+DRIVING_CODES = frozenset((5111, 5112, 5113, 5114, 5115, 5121, 5122, 5123, 5131, 5132, 5133, 5134, 5135, 5141, 5142,
+                           5143, 5144, 5145, 5146, 5147))
+BASE_SPEEDS = {
+   5111: 70,  # interstates
+   5112: 65,  # important roads, typically divided
+   5113: 55,  # primary roads
+   5114: 45,  # secondary roads
+   5115: 35,  # tertiary roads
+   5121: 25, 5122: 25,  # local/residential roads
+   5123: 15,  # pedestrian-friendly streets
+   5124: 3, 5153: 3, 5154: 3, 5155: 3, 5199: 3,  # pedestrian roads/paths or unknown
+   5131: 30, 5132: 30, 5133: 30, 5134: 30, 5135: 30,  # connector roads/ramps
+   5141: 15, 5142: 15,  # service roads/access roads/parking lots/forestry roads/agricultural use
+   5143: 25,  # grade 1 track
+   5144: 20,  # grade 2 track
+   5145: 15,  # grade 3 track
+   5146: 10,  # grade 4 track
+   5147: 5,  # grade 5 track
+   5151: 10, 5152: 10,  # horse paths/cycle paths
+}
+# The same, as lookup tables indexed by code - 5100 (all codes are in 5100-5199), for the array versions of mph
+SPEED_LUT = np.full(100, -1, np.int16)
+SPEED_LUT[[c - 5100 for c in BASE_SPEEDS]] = list(BASE_SPEEDS.values())
+DRIVING_LUT = np.zeros(100, np.bool_)
+DRIVING_LUT[[c - 5100 for c in DRIVING_CODES]] = True
+
+
 def mph(maxspeed, code, ua):
    # Internal fn for attributeOSM
-   if maxspeed >= 40 and code in (5111, 5112, 5113, 5114, 5115, 5121, 5122, 5123, 5131, 5132, 5133, 5134, 5135, 5141, 5142, 5143, 5144, 5145, 5146, 5147):
+   if maxspeed >= 40 and code in DRIVING_CODES:
       # only use maxspeed if it is a driving road AND has an assigned speed >=25 MPH (~40 kph).
       s = int(0.5 + maxspeed * 0.621371)
    else:
-      if code == 5111:
-         # interstates
-         s = 70
-      elif code == 5112:
-         # important roads, typically divided
-         s = 65
-      elif code == 5113:
-         # primary roads
-         s = 55
-      elif code == 5114:
-         # secondary roads
-         s = 45
-      elif code == 5115:
-         # tertiary roads
-         s = 35
-      elif code in (5121, 5122):
-         # local/residential roads
-         s = 25
-      elif code == 5123:
-         # pedestrian-friendly streets
-         s = 15
-      elif code in (5124, 5153, 5154, 5155, 5199):
-         # pedestrian roads/paths or unknown
-         s = 3
-      elif code in (5131, 5132, 5133, 5134, 5135):
-         # connector roads/ramps
-         s = 30
-      elif code in (5141, 5142):
-         # service roads/access roads/parking lots/forestry roads/agricultural use
-         s = 15
-      elif code == 5143:
-         # grade 1 track
-         s = 25
-      elif code == 5144:
-         # grade 2 track
-         s = 20
-      elif code == 5145:
-         # grade 3 track
-         s = 15
-      elif code == 5146:
-         # grade 4 track
-         s = 10
-      elif code == 5147:
-         # grade 5 track
-         s = 5
-      elif code in (5151, 5152):
-         # horse paths/cycle paths
-         s = 10
-      else:
-         # error catch
-         s = -1
+      s = BASE_SPEEDS.get(code, -1)
       if int(ua) == 1:
          # if code in (5111, 5112, 5113, 5114):
          if s > 30:
@@ -107,6 +94,79 @@ def tt(length_m, speed_mph):
    return t
 
 
+try:
+   # Optional: Numba, to compile mph and run it over all rows on all cores (see mphNumba)
+   from numba import njit, prange
+
+   @njit(parallel=True, cache=True)
+   def _mphKernel(maxspeed, code, ua, speedLut, drivingLut, out):
+      # Internal fn for mphNumba; the same rules as mph, using the lookup tables
+      for i in prange(code.shape[0]):
+         c = code[i] - 5100
+         known = 0 <= c < 100
+         if known and drivingLut[c] and maxspeed[i] >= 40:
+            out[i] = int(0.5 + maxspeed[i] * 0.621371)
+         else:
+            s = speedLut[c] if known else -1
+            if ua[i] == 1 and s > 30:
+               s = s - 10
+            out[i] = s
+except ImportError:
+   _mphKernel = None
+
+
+def mphNumba(maxspeed, code, ua):
+   # Internal fn for attributeOSM; the compiled version of mph over arrays
+   out = np.empty(code.shape[0], np.int16)
+   _mphKernel(np.ascontiguousarray(maxspeed, np.float64), np.ascontiguousarray(code, np.int32),
+              np.ascontiguousarray(ua, np.int32), SPEED_LUT, DRIVING_LUT, out)
+   return out
+
+
+# Array versions of rmpHwy and mph, applying the same rules to whole columns at once
+def rmpHwyArr(code):
+   # Internal fn for attributeOSM; see rmpHwy
+   return np.where(code == 5111, 2, np.where(code == 5131, 1, 0)).astype(np.int16)
+
+
+def mphArr(maxspeed, code, ua):
+   # Internal fn for attributeOSM; see mph
+   # Look up base speeds by code (unknown codes are -1), then apply the urban area adjustment
+   code = np.asarray(code)
+   known = (code >= 5100) & (code < 5200)
+   idx = np.clip(code - 5100, 0, 99)
+   s = np.where(known, SPEED_LUT[idx], -1).astype(np.int16)
+   s = np.where((np.asarray(ua).astype(int) == 1) & (s > 30), s - 10, s)
+   # Use maxspeed for driving roads with an assigned speed >= 25 MPH (~40 kph)
+   useMax = (maxspeed >= 40) & known & DRIVING_LUT[idx]
+   return np.where(useMax, np.floor(0.5 + maxspeed * 0.621371), s).astype(np.int16)
+
+
+def _deleteDuplicates(inFC, fields, geom=False):
+   # Internal fn for mergeTiles and prepOSM; deletes rows repeating the values of fields, keeping the first (lowest
+   # ObjectID). With geom=True, the line length and centroid (rounded to the XY tolerance) are also part of the key.
+   # The keys are compared with a NumPy sort, rather than DeleteIdentical's comparison of whole geometries.
+   flds = ['OID@'] + fields
+   if geom:
+      flds += ['SHAPE@LENGTH', 'SHAPE@X', 'SHAPE@Y']
+   arr = arcpy.da.FeatureClassToNumPyArray(inFC, flds, skip_nulls=True)
+   arr.sort(order='OID@')
+   key = arr[flds[1:]].copy()
+   if geom:
+      tol = arcpy.Describe(inFC).spatialReference.XYTolerance
+      for f in ['SHAPE@LENGTH', 'SHAPE@X', 'SHAPE@Y']:
+         key[f] = np.round(key[f] / tol)
+   keep = np.unique(key, return_index=True)[1]
+   drop = set(np.delete(arr['OID@'], keep).tolist())
+   del arr, key
+   if drop:
+      with arcpy.da.UpdateCursor(inFC, ['OID@']) as uc:
+         for row in uc:
+            if row[0] in drop:
+               uc.deleteRow()
+   return len(drop)
+
+
 def mergeTiles(projName):
    '''
    :param projName: Name for output merged GDB and dataset
@@ -140,19 +200,36 @@ def mergeTiles(projName):
    # coulddo: use merge? Might cause issues with memory/processing
    ls2 = ls[1:]
    print('Appending tiles to output dataset...')
-   for i in ls2:
-      print(i)
-      arcpy.Append_management(i, out, "NO_TEST")
+   # Append all tiles in one call (one write transaction), rather than one call per tile
+   if ls2:
+      print(', '.join(ls2))
+      arcpy.Append_management(ls2, out, "NO_TEST")
 
    # Clean up final dataset
    print('Deleting identical road segments...')
+   # Match on osm_id plus length and centroid rather than the whole Shape (DeleteIdentical on Shape took 15-30
+   # minutes). The geometry part of the key keeps pieces of one way that were split between tiles.
+   _deleteDuplicates(out, ['osm_id'], geom=True)
+   # Build the spatial index once the duplicate rows are gone, rather than maintaining it through the deletes
    arcpy.AddSpatialIndex_management(out)
-   arcpy.DeleteIdentical_management(out, ['Shape'])  # Can take 15-30 minutes. # osm_id?
    arcpy.Compact_management(proj_gdb)
 
    return out
 
 
+def _clipState(args):
+   # Internal fn for prepOSM; clips one state's roads to the boundary, in a worker process
+   fc, boundary, outFC = args
+   arcpy.env.outputCoordinateSystem = boundary
+   arcpy.env.extent = boundary
+   arcpy.env.overwriteOutput = True
+   # Each clip gets a GDB of its own, so that workers never write to the same GDB at once
+   gdb = os.path.dirname(outFC)
+   arcpy.CreateFileGDB_management(os.path.dirname(gdb), os.path.basename(gdb))
+   arcpy.Clip_analysis(fc, boundary, outFC)
+   return outFC
+
+
 def prepOSM(inFC, appendFC, boundary, urbanAreas, outRoads):
    '''
    For merging multiple states' OSM streets data from Geofabrik.
@@ -168,13 +245,30 @@ def prepOSM(inFC, appendFC, boundary, urbanAreas, outRoads):
 
    print('Creating merged feature class...')
    arcpy.FeatureClassToFeatureClass_conversion(inFC, wd, os.path.basename(outRoads))
-   for i in appendFC:
-      print(i)
-      arcpy.Clip_analysis(i, boundary, wd + os.sep + 'rd2')
-      arcpy.Append_management(wd + os.sep + 'rd2', outRoads, "NO_TEST")
+   # Clip the other states at the same time, each in its own process, into scratch GDBs on a local disk. Then append
+   # them all in one call.
+   # States whose extent does not reach the boundary's extent are skipped, as they have nothing to clip.
+   bndDesc = arcpy.Describe(boundary)
+   bndExt = bndDesc.extent
+   clipFC = []
+   for fc in appendFC:
+      if arcpy.Describe(fc).extent.projectAs(bndDesc.spatialReference).disjoint(bndExt):
+         print('Skipping ' + fc + ' (outside boundary extent)')
+      else:
+         clipFC.append(fc)
+   clipDir = tempfile.mkdtemp()
+   jobs = [(fc, boundary, os.path.join(clipDir, 'rd_%s.gdb' % i, 'rd2')) for i, fc in enumerate(clipFC)]
+   clips = []
+   if jobs:
+      with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count())) as ex:
+         for clip in ex.map(_clipState, jobs):
+            print(clip)
+            clips.append(clip)
+      arcpy.Append_management(clips, outRoads, "NO_TEST")
    # delete identical by osm_id (border roads are included in both state datasets)
-   arcpy.GetCount_management(outRoads)
-   arcpy.DeleteIdentical_management(outRoads, ['osm_id'])
+   _deleteDuplicates(outRoads, ['osm_id'])
+   # Rebuild the spatial index after the appends, before the location selection below
+   arcpy.AddSpatialIndex_management(outRoads)
 
    # DEPRECATED: abandoned this, as altering geometry can mess up connectivity for Network analyst
    # print('Identifying urban areas...')
@@ -185,16 +279,42 @@ def prepOSM(inFC, appendFC, boundary, urbanAreas, outRoads):
 
    # use a selection to attribute UA, so not to alter original geometry (e.g. erase or identity), which can mess up Network Analyst.
    print('Identifying roads in urban areas...')
-   lyr = arcpy.MakeFeatureLayer_management(outRoads)
-   arcpy.SelectLayerByLocation_management(lyr, 'HAVE_THEIR_CENTER_IN', urbanAreas)
    fld = 'UA'
-   efld = [a.name for a in arcpy.ListFields(outRoads)]
-   if fld not in efld:
-      arcpy.AddField_management(outRoads, fld, 'SHORT')
-   arcpy.CalculateField_management(lyr, fld, '1')
-   arcpy.SelectLayerByAttribute_management(lyr, 'SWITCH_SELECTION')
-   arcpy.CalculateField_management(lyr, fld, '0')
-   del lyr
+   # One Describe supplies the field names, OID field, and coordinate system used below
+   desc = arcpy.Describe(outRoads)
+   efld = [a.name for a in desc.fields]
+   if shapely is not None:
+      # Test all road centers against an in-memory index of the urban areas in one bulk query, and write the result in
+      # one ExtendTable call. As with HAVE_THEIR_CENTER_IN, a road's center is the point halfway along the line (not
+      # its centroid, which can fall off a curved road).
+      oids = []
+      wkb = []
+      with arcpy.da.SearchCursor(outRoads, ['OID@', 'SHAPE@WKB']) as sc:
+         for oid, g in sc:
+            if g is not None:
+               oids.append(oid)
+               wkb.append(bytes(g))
+      with arcpy.da.SearchCursor(urbanAreas, ['SHAPE@WKB'], spatial_reference=desc.spatialReference) as sc:
+         uaGeoms = shapely.from_wkb([bytes(row[0]) for row in sc if row[0] is not None])
+      pts = shapely.line_interpolate_point(shapely.from_wkb(wkb), 0.5, normalized=True)
+      del wkb
+      hits = shapely.STRtree(uaGeoms).query(pts, predicate='intersects')[0]
+      out = np.zeros(len(oids), dtype=[('OID', 'i4'), (fld, 'i2')])
+      out['OID'] = oids
+      out[fld][hits] = 1
+      del oids, pts
+      if fld in efld:
+         arcpy.DeleteField_management(outRoads, fld)
+      arcpy.da.ExtendTable(outRoads, desc.OIDFieldName, out, 'OID', append_only=False)
+   else:
+      lyr = arcpy.MakeFeatureLayer_management(outRoads)
+      arcpy.SelectLayerByLocation_management(lyr, 'HAVE_THEIR_CENTER_IN', urbanAreas)
+      if fld not in efld:
+         arcpy.AddField_management(outRoads, fld, 'SHORT')
+      arcpy.CalculateField_management(lyr, fld, '1')
+      arcpy.SelectLayerByAttribute_management(lyr, 'SWITCH_SELECTION')
+      arcpy.CalculateField_management(lyr, fld, '0')
+      del lyr
 
    # DEPRECATED
    # fld = 'UA'
@@ -210,7 +330,9 @@ def prepOSM(inFC, appendFC, boundary, urbanAreas, outRoads):
    #       curs.updateRow(i)
 
    # clean up
-   arcpy.Delete_management([wd + os.sep + 'rd2'])
+   if clips:
+      arcpy.Delete_management([os.path.dirname(c) for c in clips])
+   shutil.rmtree(clipDir, ignore_errors=True)
    return outRoads
 
 
@@ -220,40 +342,40 @@ def attributeOSM(inRoads):
    1. assign 'RmpHwy' field (Highway=2, Ramp=1, other roads=0)
    2. add SPEED_MPH field
    3. add TT_MIN field
-   Note: uses internal functions from helper.py to calculate fields.
-   Calcuations done using UpdateCursor for faster performance.
+   Note: uses internal functions [rmpHwyArr, mphArr (or mphNumba, if Numba is installed), tt] to calculate fields.
+   Calculations are done on NumPy arrays, read and written in a single pass each.
    '''
-   efld = [a.name for a in arcpy.ListFields(inRoads)]
+   # Read the inputs once into arrays, calculate all three fields with NumPy, and write them back in one ExtendTable
+   # call. ExtendTable cannot overwrite fields, so any existing output fields are dropped first.
+   print('Reading road attributes...')
+   desc = arcpy.Describe(inRoads)
+   # Read lengths from the stored length field (e.g. Shape_Length in a GDB), so geometries are not decoded to measure
+   # them. Inputs without one (e.g. shapefiles) fall back to the geometry length.
+   lenFld = getattr(desc, 'lengthFieldName', '') or 'SHAPE@LENGTH'
+   arr = arcpy.da.FeatureClassToNumPyArray(inRoads, ['OID@', 'code', 'maxspeed', 'UA', lenFld],
+                                           null_value={'maxspeed': 0, 'UA': 0})
+   out = np.empty(len(arr), dtype=[('OID', 'i4'), ('RmpHwy', 'i2'), ('SPEED_MPH', 'i2'), ('TT_MIN', 'f8')])
+   out['OID'] = arr['OID@']
 
    print('Assigning ramp/highway designations...')
-   fld = 'RmpHwy'
-   if fld not in efld:
-      arcpy.AddField_management(inRoads, fld, 'SHORT')
-   with arcpy.da.UpdateCursor(inRoads, ['code', fld]) as curs:
-      for i in curs:
-         val = rmpHwy(i[0])
-         i[1] = val
-         curs.updateRow(i)
+   out['RmpHwy'] = rmpHwyArr(arr['code'])
 
    print('Assigning road speeds...')
-   fld = 'SPEED_MPH'
-   if fld not in efld:
-      arcpy.AddField_management(inRoads, fld, 'SHORT')
-   with arcpy.da.UpdateCursor(inRoads, ['maxspeed', 'code', 'UA', fld]) as curs:
-      for i in curs:
-         val = mph(i[0], i[1], i[2])
-         i[3] = val
-         curs.updateRow(i)
+   if _mphKernel is not None:
+      out['SPEED_MPH'] = mphNumba(arr['maxspeed'], arr['code'], arr['UA'])
+   else:
+      out['SPEED_MPH'] = mphArr(arr['maxspeed'], arr['code'], arr['UA'])
 
    print('Assigning road travel times...')
-   fld = 'TT_MIN'
-   if fld not in efld:
-      arcpy.AddField_management(inRoads, fld, 'DOUBLE')
-   with arcpy.da.UpdateCursor(inRoads, ['Shape_Length', 'SPEED_MPH', fld]) as curs:
-      for i in curs:
-         val = tt(i[0], i[1])
-         i[2] = val
-         curs.updateRow(i)
+   out['TT_MIN'] = tt(arr[lenFld], out['SPEED_MPH'])
+   del arr
+
+   # All three fields are dropped in one DeleteField call and added in one ExtendTable call, so the schema is locked
+   # and rewritten twice at most
+   drop = [f.name for f in desc.fields if f.name in ('RmpHwy', 'SPEED_MPH', 'TT_MIN')]
+   if drop:
+      arcpy.DeleteField_management(inRoads, drop)
+   arcpy.da.ExtendTable(inRoads, desc.OIDFieldName, out, 'OID', append_only=False)
 
    return inRoads
 
@@ -267,25 +389,38 @@ def makeNetworkDataset(inRoads, outGDB, fdName="RoadsNet", netName="RoadsNet_ND"
    # make ramp endpoints, to account for cases where link (ramp) does not connect to an endpoint of a road.
    # Adding these points to the network will override the default endpoint-only policy for limited access highways.
    lyr = arcpy.MakeFeatureLayer_management(inRoads, where_clause="RmpHwy = 1")
-   arcpy.FeatureVerticesToPoints_management(lyr, os.path.join(outGDB, 'rmp'), "BOTH_ENDS")
+   rmp = os.path.join('memory', 'rmp')
+   arcpy.FeatureVerticesToPoints_management(lyr, rmp, "BOTH_ENDS")
    del lyr
-   lyr_rmp = arcpy.MakeFeatureLayer_management(os.path.join(outGDB, 'rmp'))
+   # Keep ramp ends falling on another road, including mid-line (the cases this step is for). OSM roads connect at
+   # shared vertices, so this is a match of coordinates (snapped to the XY tolerance) against the vertices of the other
+   # roads. Only the roads touching a ramp end (by a spatial selection) have their vertices read.
+   tol = arcpy.Describe(rmp).spatialReference.XYTolerance
+   pts = arcpy.da.FeatureClassToNumPyArray(rmp, ['OID@', 'SHAPE@X', 'SHAPE@Y'])
    lyr_rd = arcpy.MakeFeatureLayer_management(inRoads, where_clause="RmpHwy <> 1")
-   arcpy.SelectLayerByLocation_management(lyr_rmp, "INTERSECT", lyr_rd)
-   arcpy.FeatureClassToFeatureClass_conversion(lyr_rmp, os.path.join(outGDB, fdName), 'Ramp_Points')
-   del lyr_rmp, lyr_rd
-   arcpy.Delete_management(os.path.join(outGDB, 'rmp'))
+   arcpy.SelectLayerByLocation_management(lyr_rd, "INTERSECT", rmp)
+   vtx = arcpy.da.FeatureClassToNumPyArray(lyr_rd, ['SHAPE@X', 'SHAPE@Y'], explode_to_points=True)
+   del lyr_rd
+   keys = [np.ascontiguousarray(np.round(np.column_stack((a['SHAPE@X'], a['SHAPE@Y'])) / tol).astype(np.int64))
+           .view(np.dtype((np.void, 16))).ravel() for a in (pts, vtx)]
+   drop = set(pts['OID@'][~np.isin(keys[0], keys[1])].tolist())
+   del pts, vtx, keys
+   if drop:
+      with arcpy.da.UpdateCursor(rmp, ['OID@']) as uc:
+         for row in uc:
+            if row[0] in drop:
+               uc.deleteRow()
+   arcpy.FeatureClassToFeatureClass_conversion(rmp, os.path.join(outGDB, fdName), 'Ramp_Points')
+   arcpy.Delete_management(rmp)
    # Not adding points for motorway direct connection to other roads, since endpoints should match.
 
    print('Selecting motorways and links...')
    # Add feature classes to feature dataset
-   lyr = arcpy.MakeFeatureLayer_management(inRoads)
-   arcpy.SelectLayerByAttribute_management(lyr, "NEW_SELECTION", "RmpHwy IN (1,2)")
-   arcpy.FeatureClassToFeatureClass_conversion(lyr, os.path.join(outGDB, fdName), 'Roads_Hwy')
+   arcpy.FeatureClassToFeatureClass_conversion(inRoads, os.path.join(outGDB, fdName), 'Roads_Hwy',
+                                               where_clause="RmpHwy IN (1,2)")
    print('Selecting all other roads...')
-   arcpy.SelectLayerByAttribute_management(lyr, "SWITCH_SELECTION")
-   arcpy.FeatureClassToFeatureClass_conversion(lyr, os.path.join(outGDB, fdName), 'Roads_Local')
-   del lyr
+   arcpy.FeatureClassToFeatureClass_conversion(inRoads, os.path.join(outGDB, fdName), 'Roads_Local',
+                                               where_clause="RmpHwy NOT IN (1,2) OR RmpHwy IS NULL")
 
    print('Making network dataset...')
    arcpy.CreateNetworkDataset_na(os.path.join(outGDB, fdName), netName, ['Roads_Hwy', 'Roads_Local', 'Ramp_Points'])
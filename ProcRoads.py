@@ -30,94 +30,135 @@
 
 # Import Helper module and functions
 from Helper import *
+import numpy as np
+import tempfile
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+try:
+   # Optional: shapely, for matching ramp endpoints to roads in memory (see RampPts)
+   import shapely
+except ImportError:
+   shapely = None
+
+
+# Road speeds (MPH) by MTFCC code, used when a road has no usable speed of its own. Codes not listed get 3 (walking pace).
+SPEEDS_VA = {'S1100': 55, 'S1100HOV': 55,
+             'S1200': 45, 'S1200LOC': 45, 'S1200PRI': 45, 'S1300': 45, 'S1640': 45,
+             'S1630': 30,
+             'C3061': 25, 'C3062': 25, 'S1400': 25, 'S1740': 25,
+             'S1500': 15, 'S1730': 15, 'S1780': 15,
+             'S1820': 10}
+# For TIGER roads. S1100, S1200, and S1640 also depend on the route type (see _speedTIGER).
+SPEEDS_TIGER = {'S1630': 30,  # ramps
+                'C3061': 25, 'C3062': 25, 'S1400': 25, 'S1740': 25,  # residential/other roads
+                'S1500': 15, 'S1730': 15, 'S1780': 15,  # 4WD, alleys, and parking lots
+                'S1820': 10}  # bike path
+# Limited access highways (2) and ramps (1). Other codes get 0.
+RMPHWY = {'S1100': 2, 'S1100HOV': 2, 'S1630': 1}
+
+
+def _mapUnique(func, *cols):
+   # Internal fn; applies the scalar fn func to each row of the array columns cols, calling it only once per distinct
+   # combination of values
+   keys, inv = np.unique(np.rec.fromarrays(cols), return_inverse=True)
+   return np.array([func(*k) for k in keys.tolist()])[inv.ravel()]
+
+
+def _flgVA(exists, speed):
+   # Internal fn for PrepRoadsVA_tt; flags suspect speeds (-1 = set to walking pace, 1 = set by MTFCC, 0 = keep)
+   if exists == "N":
+      return -1
+   else:
+      if not speed or speed == 0 or speed % 5 != 0:
+         return 1
+      else:
+         return 0
+
+
+def _speedVA(flgfld, mtfcc, speed):
+   # Internal fn for PrepRoadsVA_tt; road speed (MPH) for a VA RCL segment
+   if flgfld == 1:
+      return SPEEDS_VA.get(mtfcc, 3)
+   elif flgfld == -1:
+      return 3
+   else:
+      return speed
+
+
+def _speedTIGER(mtfcc, rttyp):
+   # Internal fn for PrepRoadsTIGER_tt; road speed (MPH) for a TIGER segment
+   if mtfcc == 'S1100':
+      if rttyp == 'I':
+         return 70
+      else:
+         return 65
+   elif mtfcc in ('S1200', 'S1640'):
+      # secondary roads (not limited access)
+      if rttyp in ('I', 'S', 'U'):
+         # interstates, state roads, u.s. roads
+         return 55
+      else:
+         return 45
+   else:
+      return SPEEDS_TIGER.get(mtfcc, 3)
+
 
+def _rmpHwy(mtfcc):
+   # Internal fn for PrepRoadsVA_tt and PrepRoadsTIGER_tt; limited access highway (2), ramp (1), or other road (0)
+   return RMPHWY.get(mtfcc, 0)
 
-def PrepRoadsVA_tt(inRCL, outSubset=None):
+
+def PrepRoadsVA_tt(inRCL, outSubset=None, addCmntFld=False):
    """Prepares a Virginia Road Centerlines (RCL) feature class to be used for travel time analysis. This function assumes that there already exist some specific fields, including:
     - LOCAL_SPEED_MPH
     - MTFCC
     - SEGMENT_EXISTS
     - RCL_ID
     If any of the assumed fields do not exist, have been renamed, or are in the wrong format, the script will fail.
+   Set addCmntFld to True to also add an empty 'SPEED_cmnt' field for QC comments.
 
    This function was adapted from a ModelBuilder tool created by Kirsten R. Hazler and Tracy Tien for the Development Vulnerability Model (2015)"""
 
    # Process: Create "SPEED_cmnt" field.
-   # This field can be used to store QC comments related to speed, if needed.
-   printMsg("Adding 'SPEED_cmt' field...")
-   arcpy.AddField_management(inRCL, "SPEED_cmnt", "TEXT", "", "", 50)
-   # Process: Create and calculate "FlgFld"
-   # This field is used to flag records with suspect LOCAL_SPEED_MPH values
+   # This field can be used to store QC comments related to speed, if needed. Nothing here fills it, so it is only
+   # added on request.
+   if addCmntFld:
+      printMsg("Adding 'SPEED_cmt' field...")
+      arcpy.AddField_management(inRCL, "SPEED_cmnt", "TEXT", "", "", 50)
+   # Process: Calculate "FlgFld", "SPEED_upd", "TravTime", "RmpHwy", and "UniqueID" fields
+   # FlgFld is used to flag records with suspect LOCAL_SPEED_MPH values
    # 1 = Flagged: need to update speed based on MTFCC field
    # -1 = Flagged: need to set speed to 3 (walking pace)
    # 0 = Unflagged: record assumed to be fine as is
-   printMsg("Adding and populating 'FlgFld' field...")
-   arcpy.AddField_management(inRCL, "FlgFld", "LONG")
-   codeblock = """def Flg (exists, speed):
-      if exists == "N":
-         return -1
-      else:
-         if not speed or speed == 0 or speed % 5 != 0:
-            return 1
-         else:
-            return 0"""
-   expression = "Flg(!SEGMENT_EXISTS!,!LOCAL_SPEED_MPH!)"
-   arcpy.CalculateField_management(inRCL, "FlgFld", expression, "PYTHON3", codeblock)
-
-   # Process: Create and calculate "SPEED_upd" field.
-   # This field is used to store speed values to be used in later processing. It allows for altering speed values according to QC criteria, without altering original values in the  existing "LOCAL_SPEED_MPH" field. 
-   printMsg("Adding and populating 'SPEED_upd' field...")
-   arcpy.AddField_management(inRCL, "SPEED_upd", "LONG")
-   codeblock = """def SpdUpd(flgfld, mtfcc, speed):
-      if flgfld == 1:
-         if mtfcc in ['S1100','S1100HOV']:
-            return 55
-         elif mtfcc in ['S1200','S1200LOC','S1200PRI','S1300', 'S1640']:
-            return 45
-         elif mtfcc == 'S1630':
-            return 30
-         elif mtfcc in ['C3061', 'C3062', 'S1400', 'S1740']:
-            return 25
-         elif mtfcc in ['S1500', 'S1730', 'S1780']:
-            return 15
-         elif mtfcc == 'S1820':
-            return 10
-         else:  
-            return 3
-      elif flgfld == -1:
-         return 3
-      else:
-         return speed"""
-   expression = "SpdUpd(!FlgFld!, !MTFCC!, !LOCAL_SPEED_MPH!)"
-   arcpy.CalculateField_management(inRCL, "SPEED_upd", expression, "PYTHON3", codeblock)
-
-   # Process: Create and calculate "TravTime" field
-   # This field is used to store the travel time, in minutes, required to travel 1 meter, based on the road speed designation.
-   printMsg("Adding and populating 'TravTime' field...")
-   arcpy.AddField_management(inRCL, "TravTime", "DOUBLE")
-   expression = "0.037/ !SPEED_upd!"
-   arcpy.CalculateField_management(inRCL, "TravTime", expression, "PYTHON3")
-
-   # Process: Create and calculate the "RmpHwy" field
-   # This field indicates if a road is a limited access highway (2), a ramp (1), or any other road type (0)
-   printMsg("Adding and populating 'RmpHwy' field...")
-   arcpy.AddField_management(inRCL, "RmpHwy", "SHORT")
-   codeblock = """def RmpHwy (mtfcc):
-      if mtfcc in ("S1100", "S1100HOV"):
-         return 2
-      elif mtfcc == "S1630":
-         return 1
-      else:
-         return 0"""
-   expression = "RmpHwy(!MTFCC!)"
-   arcpy.CalculateField_management(inRCL, "RmpHwy", expression, "PYTHON3", codeblock)
-
-   # Process: Create and calculate the "UniqueID" field
-   # This field stores a unique ID with a state prefix for ease of merging data from different states.
-   printMsg("Adding and populating 'UniqueID' field...")
-   arcpy.AddField_management(inRCL, "UniqueID", "TEXT", "", "", "16")
-   expression = "'VA_' +  str(int(!RCL_ID!))"
-   arcpy.CalculateField_management(inRCL, "UniqueID", expression, "PYTHON3")
+   # SPEED_upd is used to store speed values to be used in later processing. It allows for altering speed values according to QC criteria, without altering original values in the  existing "LOCAL_SPEED_MPH" field.
+   # TravTime is used to store the travel time, in minutes, required to travel 1 meter, based on the road speed designation.
+   # RmpHwy indicates if a road is a limited access highway (2), a ramp (1), or any other road type (0)
+   # UniqueID stores a unique ID with a state prefix for ease of merging data from different states.
+   # The input columns are read once into arrays, the rules are applied once per distinct combination of inputs
+   # (see _mapUnique), and the fields are written back with ExtendTable. Rows with a null RCL_ID are left out of the
+   # UniqueID array, so ExtendTable leaves their UniqueID null.
+   printMsg("Calculating 'FlgFld', 'SPEED_upd', 'TravTime', 'RmpHwy', and 'UniqueID' fields...")
+   desc = arcpy.Describe(inRCL)
+   arr = arcpy.da.FeatureClassToNumPyArray(inRCL, ["OID@", "SEGMENT_EXISTS", "LOCAL_SPEED_MPH", "MTFCC", "RCL_ID"],
+                                           null_value={"SEGMENT_EXISTS": "", "LOCAL_SPEED_MPH": 0, "MTFCC": "",
+                                                       "RCL_ID": -1})
+   out = np.empty(len(arr), dtype=[("OID", "i4"), ("FlgFld", "i4"), ("SPEED_upd", "i4"), ("TravTime", "f8"),
+                                   ("RmpHwy", "i2")])
+   out["OID"] = arr["OID@"]
+   out["FlgFld"] = _mapUnique(_flgVA, arr["SEGMENT_EXISTS"], arr["LOCAL_SPEED_MPH"])
+   out["SPEED_upd"] = _mapUnique(_speedVA, out["FlgFld"], arr["MTFCC"], arr["LOCAL_SPEED_MPH"])
+   out["TravTime"] = 0.037 / out["SPEED_upd"]
+   out["RmpHwy"] = _mapUnique(_rmpHwy, arr["MTFCC"])
+   hasID = arr["RCL_ID"] != -1
+   ids = np.empty(hasID.sum(), dtype=[("OID", "i4"), ("UniqueID", "U16")])
+   ids["OID"] = arr["OID@"][hasID]
+   ids["UniqueID"] = np.char.add("VA_", arr["RCL_ID"][hasID].astype(np.int64).astype(str))
+   del arr, hasID
+   drop = [f.name for f in desc.fields if f.name in ("FlgFld", "SPEED_upd", "TravTime", "RmpHwy", "UniqueID")]
+   if drop:
+      arcpy.DeleteField_management(inRCL, drop)
+   arcpy.da.ExtendTable(inRCL, desc.OIDFieldName, out, "OID", append_only=False)
+   arcpy.da.ExtendTable(inRCL, desc.OIDFieldName, ids, "OID", append_only=False)
 
    if outSubset:
       print("Outputting subset of driving-only roads (" + outSubset + ")...")
@@ -128,6 +169,16 @@ def PrepRoadsVA_tt(inRCL, outSubset=None):
    return inRCL
 
 
+def _clipRoads(args):
+   """Internal fn for PrepRoadsTIGER_tt. Clips one roads dataset to the boundary, in a worker process. Each clip gets a
+   GDB of its own, so that workers never write to the same GDB at once."""
+   inRoads, inBnd, outRoads = args
+   gdb = os.path.dirname(outRoads)
+   arcpy.CreateFileGDB_management(os.path.dirname(gdb), os.path.basename(gdb))
+   arcpy.Clip_analysis(inRoads, inBnd, outRoads)
+   return outRoads
+
+
 def PrepRoadsTIGER_tt(inDir, outRoads, outSubset=None, inBnd=None, urbAreas=None):
    """Prepares a set of TIGER line shapefiles representing roads to be used for travel time analysis. This function assumes that there already exist some specific fields, including:
    - MTFCC
@@ -142,90 +193,58 @@ def PrepRoadsTIGER_tt(inDir, outRoads, outSubset=None, inBnd=None, urbAreas=None
 
    printMsg("Merging TIGER roads datasets...")
 
-   if inBnd:
+   if inBnd and len(inList) > 1:
+      # Process: Clip each dataset to boundary at the same time, each in its own process with its own scratch GDB,
+      # then merge the clipped roads
+      printMsg("Clipping roads to boundary...")
+      clipDir = tempfile.mkdtemp()
+      jobs = [(os.path.join(inDir, fc), inBnd, os.path.join(clipDir, 'rd_%s.gdb' % i, 'rd')) for i, fc in enumerate(inList)]
+      with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count())) as ex:
+         clips = list(ex.map(_clipRoads, jobs))
+      arcpy.Merge_management(clips, outRoads)
+      garbagePickup([os.path.dirname(c) for c in clips])
+      shutil.rmtree(clipDir, ignore_errors=True)
+   elif inBnd:
       # Process: Clip to boundary
-      mergeRds = scratchGDB + os.sep + "mergeRds"
+      mergeRds = os.path.join("memory", "mergeRds")
       arcpy.Merge_management(inList, mergeRds)
       printMsg("Clipping roads to boundary...")
       arcpy.Clip_analysis(mergeRds, inBnd, outRoads)
+      garbagePickup([mergeRds])
    else:
       arcpy.Merge_management(inList, outRoads)
 
-   # Process: Create and calculate "SPEED_upd" field.
-   # This field is used to store speed values to be used in later processing. It allows for altering speed values according to QC criteria
-   printMsg("Adding and populating 'Speed_upd' field...")
-   arcpy.AddField_management(outRoads, "Speed_upd", "LONG")
-   codeblock = """def Speed(mtfcc, rttyp):
-      if mtfcc == 'S1100':
-         if rttyp == 'I':
-            return 70
-         else:
-            return 65
-      elif mtfcc in ['S1200', 'S1640']:
-         # secondary roads (not limited access)
-         if rttyp in ['I','S','U']:
-            # interstates, state roads, u.s. roads
-            return 55
-         else:
-            return 45
-      elif mtfcc == 'S1630':
-         # ramps
-         return 30
-      elif mtfcc in ['C3061', 'C3062', 'S1400', 'S1740']:
-         # residential/other roads
-         return 25
-      elif mtfcc in ['S1500', 'S1730', 'S1780']:
-         # 4WD, alleys, and parking lots
-         return 15
-      elif mtfcc == 'S1820':
-         # bike path
-         return 10
-      else:  
-         return 3"""
-   expression = "Speed(!MTFCC!,!RTTYP!)"
-   arcpy.CalculateField_management(outRoads, "Speed_upd", expression, "PYTHON3", codeblock)
+   # Process: Create "Speed_upd", "TravTime", "RmpHwy", and "UniqueID" fields
+   # Speed_upd is used to store speed values to be used in later processing. It allows for altering speed values according to QC criteria
+   # TravTime is used to store the travel time, in minutes, required to travel 1 meter, based on the road speed designation.
+   # RmpHwy indicates if a road is a limited access highway (2), a ramp (1), or any other road type (0)
+   # UniqueID stores a unique ID with a state prefix for ease of merging data from different states.
+   printMsg("Adding 'Speed_upd', 'TravTime', 'RmpHwy', and 'UniqueID' fields...")
+   # Add all four in one call (one schema change), rather than one AddField call each
+   arcpy.AddFields_management(outRoads, [["Speed_upd", "LONG"], ["TravTime", "DOUBLE"], ["RmpHwy", "SHORT"],
+                                         ["UniqueID", "TEXT", "", 30]])
+
+   # One update cursor fills all four fields in a single pass
+   printMsg("Populating fields...")
+   flds = ["MTFCC", "RTTYP", "LINEARID", "Speed_upd", "TravTime", "RmpHwy", "UniqueID"]
+   with arcpy.da.UpdateCursor(outRoads, flds) as uc:
+      for row in uc:
+         mtfcc, rttyp, linearID = row[:3]
+         spd = _speedTIGER(mtfcc, rttyp)
+         row[3:] = [spd, 0.037 / spd, _rmpHwy(mtfcc), None if linearID is None else 'TL_' + linearID]
+         uc.updateRow(row)
 
    # reduce speeds by 10 mph for road segments intersecting urban areas
    if urbAreas:
       printMsg("Adjusting speeds in urban areas...")
-      noUrb = arcpy.Erase_analysis(outRoads, urbAreas, scratchGDB + os.sep + "noUrb")
-      onlyUrb = arcpy.Clip_analysis(outRoads, urbAreas, scratchGDB + os.sep + "onlyUrb")
-      codeblock = """def Speed(Speed_upd):
-         if Speed_upd > 30:
-            return Speed_upd - 10
-         else:
-            return Speed_upd"""
-      expression = "Speed(!Speed_upd!)"
-      arcpy.CalculateField_management(onlyUrb, "Speed_upd", expression, "PYTHON3", codeblock)
+      noUrb = arcpy.Erase_analysis(outRoads, urbAreas, os.path.join("memory", "noUrb"))
+      onlyUrb = arcpy.Clip_analysis(outRoads, urbAreas, os.path.join("memory", "onlyUrb"))
+      with arcpy.da.UpdateCursor(onlyUrb, ["Speed_upd", "TravTime"]) as uc:
+         for row in uc:
+            if row[0] > 30:
+               uc.updateRow([row[0] - 10, 0.037 / (row[0] - 10)])
       outRoads = arcpy.Merge_management([noUrb, onlyUrb], outRoads + '_urbAdjust')
-
-   # Process: Create and calculate "TravTime" field
-   # This field is used to store the travel time, in minutes, required to travel 1 meter, based on the road speed designation.
-   printMsg("Adding and populating 'TravTime' field...")
-   arcpy.AddField_management(outRoads, "TravTime", "DOUBLE")
-   expression = "0.037/ !SPEED_upd!"
-   arcpy.CalculateField_management(outRoads, "TravTime", expression, "PYTHON3")
-
-   # Process: Create and calculate the "RmpHwy" field
-   # This field indicates if a road is a limited access highway (2), a ramp (1), or any other road type (0)
-   printMsg("Adding and populating 'RmpHwy' field...")
-   arcpy.AddField_management(outRoads, "RmpHwy", "SHORT")
-   codeblock = """def RmpHwy(mtfcc):
-      if mtfcc in ("S1100", "S1100HOV"):
-         return 2
-      elif mtfcc == "S1630":
-         return 1
-      else:
-         return 0"""
-   expression = "RmpHwy(!MTFCC!)"
-   arcpy.CalculateField_management(outRoads, "RmpHwy", expression, "PYTHON3", codeblock)
-
-   # Process: Create and calculate the "UniqueID" field
-   # This field stores a unique ID with a state prefix for ease of merging data from different states.
-   printMsg("Adding and populating 'UniqueID' field...")
-   arcpy.AddField_management(outRoads, "UniqueID", "TEXT", "", "", "30")
-   expression = "'TL_' + !LINEARID!"
-   arcpy.CalculateField_management(outRoads, "UniqueID", expression, "PYTHON3")
+      garbagePickup([noUrb, onlyUrb])
 
    if outSubset:
       print("Outputting subset of driving-only roads (" + outSubset + ")...")
@@ -265,11 +284,107 @@ def MergeRoads_tt(inList, outRoads):
    # Merge datasets
    printMsg("Merging datasets...")
    arcpy.Merge_management(inList, outRoads, fldMappings)
+   # The merged roads are the target of location selections later on (see RampPts)
+   arcpy.AddSpatialIndex_management(outRoads)
 
    printMsg("Mission accomplished.")
    return outRoads
 
 
+def _endPoints(inLines, outPts):
+   """Internal fn for RampPts. Writes the first and last points of each line to a new point feature class, with the
+   line's attributes and an ORIG_FID field, like FeatureVerticesToPoints with "BOTH_ENDS". Only the two end points of
+   each line are read, rather than every vertex."""
+   desc = arcpy.Describe(inLines)
+   arcpy.CreateFeatureclass_management(os.path.dirname(outPts), os.path.basename(outPts), "POINT", inLines,
+                                       spatial_reference=desc.spatialReference)
+   arcpy.AddField_management(outPts, "ORIG_FID", "LONG")
+   flds = [f.name for f in arcpy.ListFields(inLines) if f.editable and f.type not in ('OID', 'Geometry')]
+   with arcpy.da.SearchCursor(inLines, ["SHAPE@", "OID@"] + flds) as sc, \
+         arcpy.da.InsertCursor(outPts, ["SHAPE@XY", "ORIG_FID"] + flds) as ic:
+      for row in sc:
+         geom = row[0]
+         if geom is None:
+            continue
+         for pt in (geom.firstPoint, geom.lastPoint):
+            ic.insertRow(((pt.X, pt.Y),) + row[1:])
+   return outPts
+
+
+def _chainEnds(inLines, outPts):
+   """Internal fn for RampPts. Writes the end points of the line chains in inLines to a new point feature class. These
+   are the same points as the ends of Dissolve with "SINGLE_PART" and "UNSPLIT_LINES": nodes where the number of line
+   ends meeting is other than two. Line ends are matched on a grid at the XY tolerance, so the lines are never
+   dissolved."""
+   sr = arcpy.Describe(inLines).spatialReference
+   xy = []
+   with arcpy.da.SearchCursor(inLines, ["SHAPE@"]) as sc:
+      for row in sc:
+         if row[0] is not None:
+            p1, p2 = row[0].firstPoint, row[0].lastPoint
+            xy.extend(((p1.X, p1.Y), (p2.X, p2.Y)))
+   xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+   cells = np.round(xy / sr.XYTolerance).astype(np.int64)
+   first, counts = np.unique(cells, axis=0, return_index=True, return_counts=True)[1:]
+   arcpy.CreateFeatureclass_management(os.path.dirname(outPts), os.path.basename(outPts), "POINT",
+                                       spatial_reference=sr)
+   with arcpy.da.InsertCursor(outPts, ["SHAPE@XY"]) as ic:
+      for i in first[counts != 2]:
+         ic.insertRow(((xy[i, 0], xy[i, 1]),))
+   return outPts
+
+
+def _selectNearLines(ptsLyr, ptsFC, linesLyr):
+   """Internal fn for RampPts. Makes a new selection in ptsLyr (a layer on all of ptsFC) of the points intersecting
+   any line in linesLyr, within the XY tolerance. This does the same as SelectLayerByLocation with "INTERSECT", but
+   with one bulk query against an in-memory spatial index of the lines. Falls back to SelectLayerByLocation if shapely
+   is not installed."""
+   if shapely is None:
+      arcpy.SelectLayerByLocation_management(ptsLyr, "INTERSECT", linesLyr)
+      return ptsLyr
+   tol = arcpy.Describe(ptsFC).spatialReference.XYTolerance
+   with arcpy.da.SearchCursor(linesLyr, ['SHAPE@WKB']) as sc:
+      lines = shapely.from_wkb([bytes(row[0]) for row in sc if row[0] is not None])
+   arr = arcpy.da.FeatureClassToNumPyArray(ptsFC, ['OID@', 'SHAPE@X', 'SHAPE@Y'])
+   pts = shapely.points(np.column_stack((arr['SHAPE@X'], arr['SHAPE@Y'])))
+   hits = shapely.STRtree(lines).query(pts, predicate='dwithin', distance=tol)[0]
+   oids = np.unique(arr['OID@'][hits]).tolist()
+   arcpy.SelectLayerByAttribute_management(ptsLyr, "CLEAR_SELECTION")
+   if oids:
+      ptsLyr.getOutput(0).setSelectionSet(oids, 'NEW')
+   else:
+      # An empty selection set would mean "all features" to downstream tools; select nothing explicitly instead
+      arcpy.SelectLayerByAttribute_management(ptsLyr, "NEW_SELECTION", "1 = 0")
+   return ptsLyr
+
+
+def _selectEndsAt(linesLyr, ptsFC):
+   """Internal fn for RampPts. Makes a new selection in linesLyr of the lines with an end point on any point in ptsFC
+   (matched on a grid at the XY tolerance). With the chain end points from _chainEnds, this selects the same lines as
+   SelectLayerByLocation with "BOUNDARY_TOUCHES" against the dissolved chains."""
+   tol = arcpy.Describe(ptsFC).spatialReference.XYTolerance
+   arr = arcpy.da.FeatureClassToNumPyArray(ptsFC, ['SHAPE@X', 'SHAPE@Y'])
+   ptKeys = np.round(np.column_stack((arr['SHAPE@X'], arr['SHAPE@Y'])) / tol).astype(np.int64)
+   oids = []
+   xy = []
+   arcpy.SelectLayerByAttribute_management(linesLyr, "CLEAR_SELECTION")
+   with arcpy.da.SearchCursor(linesLyr, ['OID@', 'SHAPE@']) as sc:
+      for oid, geom in sc:
+         if geom is not None:
+            oids += [oid, oid]
+            xy += [(geom.firstPoint.X, geom.firstPoint.Y), (geom.lastPoint.X, geom.lastPoint.Y)]
+   endKeys = np.round(np.array(xy, dtype=np.float64).reshape(-1, 2) / tol).astype(np.int64)
+   # Compare (x, y) cells as single 16-byte keys
+   endKeys, ptKeys = [np.ascontiguousarray(k).view(np.dtype((np.void, 16))).ravel() for k in (endKeys, ptKeys)]
+   hits = np.unique(np.array(oids, dtype=np.int64)[np.isin(endKeys, ptKeys)]).tolist()
+   if hits:
+      linesLyr.getOutput(0).setSelectionSet(hits, 'NEW')
+   else:
+      # An empty selection set would mean "all features" to downstream tools; select nothing explicitly instead
+      arcpy.SelectLayerByAttribute_management(linesLyr, "NEW_SELECTION", "1 = 0")
+   return linesLyr
+
+
 def RampPts(roads, rampPts, highway="MTFCC = 'S1100'", ramp="MTFCC = 'S1630'", local="MTFCC NOT IN ('S1100', 'S1630')"):
    """
    This functions generates 'ramp points' for use as junctions in a network dataset. It generates
@@ -280,52 +395,68 @@ def RampPts(roads, rampPts, highway="MTFCC = 'S1100'", ramp="MTFCC = 'S1630'", l
    Used as an internal fn in MakeNetworkDataset_tt.
    """
 
+   # Intermediates are kept in memory, so the repeated location selections against them never touch disk
+   r1, he1_fc, hwyEnds, tmpInts = [os.path.join('memory', n) for n in ['r1', 'he1', 'hwy_endpts', 'tmp_ints']]
+
    lyr_rmp = arcpy.MakeFeatureLayer_management(roads, where_clause=ramp)
-   arcpy.FeatureVerticesToPoints_management(lyr_rmp, "r1", "BOTH_ENDS")
-   lyr_rmppt = arcpy.MakeFeatureLayer_management("r1")
+   _endPoints(lyr_rmp, r1)
+   lyr_rmppt = arcpy.MakeFeatureLayer_management(r1)
 
    # select ramp points intersecting highways
    print('Getting junctions of ramps and highway...')
    lyr_hwy = arcpy.MakeFeatureLayer_management(roads, where_clause=highway)
-   arcpy.SelectLayerByLocation_management(lyr_rmppt, "INTERSECT", lyr_hwy)
+   _selectNearLines(lyr_rmppt, r1, lyr_hwy)
    arcpy.CopyFeatures_management(lyr_rmppt, rampPts)
    arcpy.CalculateField_management(rampPts, "junction", 1, field_type="SHORT")
 
    ## get "dead end" hwy points (transition from LAH to local road without ramp) points
-   arcpy.Dissolve_management(lyr_hwy, 'hwy_end_diss', "#", "#", "SINGLE_PART", "UNSPLIT_LINES")
-   arcpy.FeatureVerticesToPoints_management("hwy_end_diss", "he1", "BOTH_ENDS")
-   he1 = arcpy.MakeFeatureLayer_management("he1")
+   _chainEnds(lyr_hwy, he1_fc)
+   he1 = arcpy.MakeFeatureLayer_management(he1_fc)
 
    # select those highway ends intersecting with ramps
-   arcpy.SelectLayerByLocation_management(he1, "INTERSECT", lyr_rmp)
-   arcpy.CopyFeatures_management(he1, "hwy_endpts")
-   arcpy.CalculateField_management('hwy_endpts', "junction", 1, field_type="SHORT")
-   arcpy.Append_management('hwy_endpts', rampPts, "NO_TEST")
+   _selectNearLines(he1, he1_fc, lyr_rmp)
+   arcpy.CopyFeatures_management(he1, hwyEnds)
+   arcpy.CalculateField_management(hwyEnds, "junction", 1, field_type="SHORT")
+   arcpy.Append_management(hwyEnds, rampPts, "NO_TEST")
 
    # select ramp points intersecting local roads
    print('Getting junctions of ramps and local...')
    lyr_loc = arcpy.MakeFeatureLayer_management(roads, where_clause=local)
-   arcpy.SelectLayerByLocation_management(lyr_rmppt, "INTERSECT", lyr_loc)
-   arcpy.CopyFeatures_management(lyr_rmppt, 'tmp_ints')
-   arcpy.CalculateField_management('tmp_ints', "junction", 2, field_type="SHORT")
+   _selectNearLines(lyr_rmppt, r1, lyr_loc)
+   arcpy.CopyFeatures_management(lyr_rmppt, tmpInts)
+   arcpy.CalculateField_management(tmpInts, "junction", 2, field_type="SHORT")
    # This will append local ramp intersections, then delete those identical to a highway ramp intersection (hwy takes precendence)
-   arcpy.Append_management('tmp_ints', rampPts, "NO_TEST")
+   arcpy.Append_management(tmpInts, rampPts, "NO_TEST")
    arcpy.SelectLayerByAttribute_management(lyr_rmppt, "CLEAR_SELECTION")
 
    # now find highway ends that share endpoint with local roads
    print('Getting junctions of highway ends and local...')
-   arcpy.SelectLayerByLocation_management(lyr_loc, "BOUNDARY_TOUCHES", "hwy_end_diss")
+   # (local roads with an end at a highway chain end, as BOUNDARY_TOUCHES against the dissolved highways did)
+   _selectEndsAt(lyr_loc, he1_fc)
    # now select highway end points intersecting those roads
    arcpy.SelectLayerByLocation_management(he1, "INTERSECT", lyr_loc)
    # now remove those points intersecting ramps
    arcpy.SelectLayerByLocation_management(he1, "INTERSECT", lyr_rmp, "#", "REMOVE_FROM_SELECTION")
-   arcpy.CopyFeatures_management(he1, "hwy_endpts")
-   arcpy.CalculateField_management('hwy_endpts', "junction", 3, field_type="SHORT")
-   arcpy.Append_management('hwy_endpts', rampPts, "NO_TEST")
+   arcpy.CopyFeatures_management(he1, hwyEnds)
+   arcpy.CalculateField_management(hwyEnds, "junction", 3, field_type="SHORT")
+   arcpy.Append_management(hwyEnds, rampPts, "NO_TEST")
 
    print('Removing duplicate points...')
-   arcpy.DeleteIdentical_management(rampPts, ["Shape"])
-   arcpy.Delete_management(['tmp_ints', "r1", 'hwy_endpts'])
+   # Snap coordinates to a grid at the XY tolerance and keep the first point (lowest ObjectID) in each cell, so
+   # highway junctions take precedence over local ones appended after them. This replaces DeleteIdentical, which
+   # compares points pairwise.
+   tol = arcpy.Describe(rampPts).spatialReference.XYTolerance
+   arr = arcpy.da.FeatureClassToNumPyArray(rampPts, ['OID@', 'SHAPE@X', 'SHAPE@Y'])
+   arr.sort(order='OID@')
+   cells = np.round(np.column_stack((arr['SHAPE@X'], arr['SHAPE@Y'])) / tol).astype(np.int64)
+   keep = np.unique(cells, axis=0, return_index=True)[1]
+   drop = set(np.delete(arr['OID@'], keep).tolist())
+   if drop:
+      with arcpy.da.UpdateCursor(rampPts, ['OID@']) as uc:
+         for row in uc:
+            if row[0] in drop:
+               uc.deleteRow()
+   arcpy.Delete_management([tmpInts, r1, hwyEnds, he1_fc])
 
    return rampPts
 
@@ -345,11 +476,12 @@ def MakeNetworkDataset_tt(inRoads, outGDB):
       arcpy.CreateFileGDB_management(os.path.dirname(outGDB), os.path.basename(outGDB))
 
    # Remove duplicate roads, make ramp points feature class
+   # These steps are skipped on reruns if inRoads is unchanged (see cachedStep)
    rd_nodup = outGDB + os.sep + 'all_subset_nodup'
-   RemoveDupRoads(inRoads, rd_nodup)
+   cachedStep(RemoveDupRoads, inRoads, rd_nodup, inRoads, rd_nodup)
    # NOTE: use original roads for RampPts, not dup. removed, which may result in extra vertices that get turned into ramp points if used
    rmp_pts = outGDB + os.sep + "ramp_junctions"
-   RampPts(inRoads, rmp_pts)
+   cachedStep(RampPts, inRoads, rmp_pts, inRoads, rmp_pts)
 
    # Make Network GDB and feature dataset
    fd = os.path.join(outGDB, 'RCL')
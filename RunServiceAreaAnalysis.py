@@ -8,6 +8,7 @@ Created on Mon Oct 23 11:44:44 2017
 
 @author: David Bucklin
 Edited by: Kirsten Hazler, 2017-10-25
+Last edit: 2026-10-16 (updated for ArcGIS Pro / Python 3)
 """
 # Import Helper module and functions
 import Helper
@@ -60,17 +61,15 @@ else:
     exit()
 
 outputFolder = newdir
-outLayerFile = outputFolder + "/" + outNALayerName + ".lyr"
+outLayerFile = outputFolder + "/" + outNALayerName + ".lyrx"
 
 # definition query for facilities layer
-arcpy.MakeFeatureLayer_management(inFacilities,"fac")
-fac_lyr = arcpy.mapping.Layer("fac")
 valString = ((str(valList)).replace('[', '(')).replace(']', ')')
 defQuery = '"%s" in %s' %(fld, valString)
-fac_lyr.definitionQuery = defQuery
+arcpy.MakeFeatureLayer_management(inFacilities, "fac", defQuery)
 
 # how many sources?
-print 'Facilities count: ' + str(arcpy.GetCount_management("fac"))
+printMsg('Facilities count: %s' % str(countFeatures("fac")))
 
 # Make service area layer 
 outNALayer = arcpy.na.MakeServiceAreaLayer(in_network_dataset=inNetworkDataset,
@@ -153,9 +152,9 @@ printMsg('Elapsed time for export: %s.' % deltaString)
 
 # Save the facilities, lines, and polygons features to disk
 printMsg('Copying features to disk...')
-arcpy.CopyFeatures_management(in_features=arcpy.mapping.ListLayers(outNALayer, 'Facilities')[0],out_feature_class=outputFolder + "/" + outNALayerName + "_Facilities.shp")
-arcpy.CopyFeatures_management(in_features=arcpy.mapping.ListLayers(outNALayer, 'Lines')[0],out_feature_class=outputFolder + "/" + outNALayerName + "_Lines.shp")
-arcpy.CopyFeatures_management(in_features=arcpy.mapping.ListLayers(outNALayer, 'Polygons')[0],out_feature_class=outputFolder + "/" + outNALayerName + "_Polygons.shp")
+arcpy.CopyFeatures_management(in_features=arcpy.na.GetNASublayer(outNALayer, 'Facilities'),out_feature_class=outputFolder + "/" + outNALayerName + "_Facilities.shp")
+arcpy.CopyFeatures_management(in_features=arcpy.na.GetNASublayer(outNALayer, 'SALines'),out_feature_class=outputFolder + "/" + outNALayerName + "_Lines.shp")
+arcpy.CopyFeatures_management(in_features=arcpy.na.GetNASublayer(outNALayer, 'SAPolygons'),out_feature_class=outputFolder + "/" + outNALayerName + "_Polygons.shp")
 t5 = datetime.now()
 printMsg('Finished copy at %s. Process complete.' % str(t5))
 #print 'Finished exporting all features at ' + str(time.ctime())
@@ -7,7 +7,7 @@ Assumes an already-created network dataset. (See NetworkAnalyst-Setup.txt for in
 Created on Mon Oct 23 11:44:44 2017
 
 @author: David Bucklin and Kirsten Hazler
-Last edit: 2017-11-13 (krh)
+Last edit: 2026-10-16 (updated for ArcGIS Pro / Python 3)
 """
 
 
@@ -53,7 +53,7 @@ def RecServiceAreas(inNetworkDataset, inFacilities, fld_facID, fld_grpID, outDir
        exit()
 
    outputFolder = newdir
-   outLayerFile = outputFolder + os.sep + outNALayerName + ".lyr"
+   outLayerFile = outputFolder + os.sep + outNALayerName + ".lyrx"
    outGDB = outputFolder + os.sep + outNALayerName + ".gdb"
    arcpy.CreateFileGDB_management(outputFolder, outNALayerName + ".gdb")
 
@@ -162,9 +162,9 @@ def RecServiceAreas(inNetworkDataset, inFacilities, fld_facID, fld_grpID, outDir
          # Save the facilities, lines, and polygons features to disk
          arcpy.env.workspace = outGDB
          printMsg('Copying output features to disk...')
-         arcpy.CopyFeatures_management(in_features=arcpy.mapping.ListLayers(outNALayer, 'Facilities')[0],out_feature_class="Facilities_" + str(id))
-         arcpy.CopyFeatures_management(in_features=arcpy.mapping.ListLayers(outNALayer, 'Lines')[0],out_feature_class="Lines_" + str(id))
-         arcpy.CopyFeatures_management(in_features=arcpy.mapping.ListLayers(outNALayer, 'Polygons')[0],out_feature_class="Polygons_" + str(id))
+         arcpy.CopyFeatures_management(in_features=arcpy.na.GetNASublayer(outNALayer, 'Facilities'),out_feature_class="Facilities_" + str(id))
+         arcpy.CopyFeatures_management(in_features=arcpy.na.GetNASublayer(outNALayer, 'SALines'),out_feature_class="Lines_" + str(id))
+         arcpy.CopyFeatures_management(in_features=arcpy.na.GetNASublayer(outNALayer, 'SAPolygons'),out_feature_class="Polygons_" + str(id))
          t3 = datetime.now()
          printMsg('Finished copy at %s. Process complete.' % str(t3))
       except:
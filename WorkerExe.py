@@ -0,0 +1,20 @@
+# ---------------------------------------------------------------------------
+# WorkerExe.py
+# Version:  Python 3.x
+# Creation Date: 2026-10-16
+#
+# Summary:
+# Points multiprocessing worker processes at the right Python executable. Import this module before starting any
+# process pool. It has no arcpy dependency, so scripts that run without arcpy can import it too.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import multiprocessing
+
+# Inside ArcGIS Pro, sys.executable is ArcGISPro.exe, so worker processes (see ProcessPoolExecutor uses in CostDist,
+# ProcRoads, ProcOSM, and BatchExtractZipFiles) would start new copies of Pro. Point them at the environment's
+# python.exe instead.
+_pyExe = os.path.join(sys.exec_prefix, 'python.exe')
+if os.name == 'nt' and os.path.basename(sys.executable).lower() != 'python.exe' and os.path.exists(_pyExe):
+   multiprocessing.set_executable(_pyExe)